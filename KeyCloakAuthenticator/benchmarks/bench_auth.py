@@ -0,0 +1,199 @@
+"""Latency of the logins and refreshes, and blocking of the hub event loop
+
+Starts a stand-in Keycloak with the given latency in a separate process, and
+drives many concurrent simulated logins (authenticate, with the full code
+flow and the token exchanges) and refreshes (refresh_user) through
+KeyCloakAuthenticator, as the hub would:
+
+    python benchmarks/bench_auth.py --users 2000 --concurrency 1000 --latency 20
+
+For every scenario, reports the p50/p99 latency of the calls, and the p99/max
+lag of the event loop while they run (the time the hub can't answer any other
+request), with the number of requests made to Keycloak.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+from fakekeycloak import FakeKeycloak
+from keycloakauthenticator import KeyCloakAuthenticator
+
+LAG_INTERVAL = 0.005
+
+
+def _serve(latency, exchanged_lifetime, queue):
+    keycloak = FakeKeycloak(latency=latency, exchanged_lifetime=exchanged_lifetime)
+    queue.put(keycloak.listen())
+    IOLoop.current().start()
+
+
+class _Handler(object):
+    """Callback of the login of a user, as seen by authenticate"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_argument(self, name):
+        # the fake Keycloak takes the user name as authorization code
+        return self.name
+
+
+class _User(object):
+    def __init__(self, name, auth_state):
+        self.name = name
+        self.auth_state = auth_state
+
+    async def get_auth_state(self):
+        # a copy, as decrypted from the database by the hub
+        return json.loads(json.dumps(self.auth_state))
+
+    async def save_auth_state(self, auth_state):
+        self.auth_state = json.loads(json.dumps(auth_state))
+
+
+class _LagMonitor(object):
+    """Delay of the event loop to wake up a task that sleeps LAG_INTERVAL"""
+
+    def __init__(self):
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lags.append(max(0, time.perf_counter() - start - LAG_INTERVAL))
+
+    def start(self):
+        self.lags = []
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self._task.cancel()
+        return self.lags or [0]
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+async def _stats(issuer):
+    resp = await AsyncHTTPClient().fetch(issuer.split('/realms/')[0] + '/stats')
+    return json.loads(resp.body)
+
+
+async def _scenario(name, calls, concurrency, issuer):
+    """Run the calls (coroutine functions) with at most concurrency at the same time"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def timed(call):
+        async with semaphore:
+            start = time.perf_counter()
+            result = await call()
+            latencies.append(time.perf_counter() - start)
+            return result
+
+    stats = await _stats(issuer)
+    monitor = _LagMonitor()
+    monitor.start()
+    start = time.perf_counter()
+    results = await asyncio.gather(*[timed(call) for call in calls])
+    duration = time.perf_counter() - start
+    lags = monitor.stop()
+    requests = sum((await _stats(issuer)).values()) - sum(stats.values())
+    failed = sum(1 for result in results if not result)
+    print(
+        "%-26s %7i %7i %9.1f %9.1f %9.1f %9.1f %9.1f %9i"
+        % (
+            name,
+            len(calls),
+            failed,
+            len(calls) / duration,
+            1000 * _percentile(latencies, 0.5),
+            1000 * _percentile(latencies, 0.99),
+            1000 * _percentile(lags, 0.99),
+            1000 * max(lags),
+            requests,
+        )
+    )
+    return results
+
+
+async def _run(args, issuer):
+    authenticator = KeyCloakAuthenticator(
+        oidc_issuer=issuer,
+        client_id='swan',
+        client_secret='secret',
+        oauth_callback_url='http://127.0.0.1/hub/oauth_callback',
+        username_key='preferred_username',
+        exchange_tokens=['audience%i' % i for i in range(args.audiences)],
+        oidc_cache_path='',
+        token_request_timeout=600,
+        token_cache_size=args.token_cache_size,
+    )
+    names = ['user%i' % i for i in range(args.users)]
+
+    print(
+        "%-26s %7s %7s %9s %9s %9s %9s %9s %9s"
+        % ('scenario', 'calls', 'failed', 'calls/s', 'p50 ms', 'p99 ms', 'lag p99', 'lag max', 'keycloak')
+    )
+    logins = await _scenario(
+        'login',
+        [lambda name=name: authenticator.authenticate(_Handler(name)) for name in names],
+        args.concurrency,
+        issuer,
+    )
+    users = [_User(login['name'], login['auth_state']) for login in logins if login]
+
+    def refresh(user):
+        # the refreshed tokens are saved in the user by refresh_user
+        return lambda: authenticator.refresh_user(user)
+
+    await _scenario('refresh', [refresh(user) for user in users], args.concurrency, issuer)
+    await _scenario(
+        'refresh, %i tabs per user' % args.tabs,
+        [refresh(user) for user in users for _ in range(args.tabs)],
+        args.concurrency,
+        issuer,
+    )
+    # every exchanged token is about to expire
+    authenticator.exchange_tokens_margin = 10 * 24 * 3600
+    await _scenario('refresh, exchange all', [refresh(user) for user in users], args.concurrency, issuer)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000, help="Number of users logging in and refreshing")
+    parser.add_argument('--concurrency', type=int, default=1000, help="Calls running at the same time")
+    parser.add_argument('--latency', type=float, default=20, help="Latency of Keycloak, in milliseconds")
+    parser.add_argument('--audiences', type=int, default=2, help="Number of audiences to exchange the token for")
+    parser.add_argument('--tabs', type=int, default=3, help="Concurrent refreshes of the same user")
+    parser.add_argument('--max-clients', type=int, default=100, help="Concurrent requests of the HTTP client")
+    parser.add_argument('--token-cache-size', type=int, default=1024, help="0 to verify every token again")
+    parser.add_argument(
+        '--exchanged-lifetime', type=int, default=3600, help="Lifetime of the exchanged tokens, in seconds"
+    )
+    args = parser.parse_args()
+
+    AsyncHTTPClient.configure(None, max_clients=args.max_clients)
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=_serve, args=(args.latency / 1000, args.exchanged_lifetime, queue), daemon=True
+    )
+    server.start()
+    issuer = queue.get()
+    try:
+        IOLoop.current().run_sync(lambda: _run(args, issuer))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
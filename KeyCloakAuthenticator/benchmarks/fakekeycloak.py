@@ -0,0 +1,192 @@
+"""Local stand-in for Keycloak, used to benchmark the authenticator
+
+Implements only the OIDC endpoints used by KeyCloakAuthenticator: the
+discovery document, the signing keys (JWKS), the token endpoint (grants
+authorization_code, refresh_token and token exchange) and the user info.
+Every request waits latency seconds before answering, without blocking.
+
+The authorization code is the name of the user logging in. As in Keycloak,
+the access tokens are signed with the RSA key of the JWKS and the refresh
+tokens with a secret HMAC key.
+"""
+import asyncio
+import json
+import secrets
+import time
+from collections import Counter
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+TOKEN_EXCHANGE = 'urn:ietf:params:oauth:grant-type:token-exchange'
+
+
+class FakeKeycloak(object):
+    """Serve a realm with the given client
+
+    access_lifetime and exchanged_lifetime are the lifetimes (in seconds)
+    of the access tokens and of the exchanged tokens.
+    """
+
+    def __init__(self, client_id='swan', latency=0, access_lifetime=300, exchanged_lifetime=3600, roles=('swan-users',)):
+        self.client_id = client_id
+        self.latency = latency
+        self.access_lifetime = access_lifetime
+        self.exchanged_lifetime = exchanged_lifetime
+        self.roles = list(roles)
+        self.issuer = None
+        # number of requests received, by endpoint (and grant, for the token endpoint)
+        self.requests = Counter()
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self._kid = secrets.token_hex(8)
+        self._hmac_secret = secrets.token_bytes(32)
+        # the hub doesn't check the exchanged tokens, they are only signed once, with the cheaper HMAC key
+        self._exchanged = {}
+        self._server = None
+
+    def discovery(self):
+        base = self.issuer + '/protocol/openid-connect'
+        return {
+            'issuer': self.issuer,
+            'authorization_endpoint': base + '/auth',
+            'token_endpoint': base + '/token',
+            'userinfo_endpoint': base + '/userinfo',
+            'end_session_endpoint': base + '/logout',
+            'jwks_uri': base + '/certs',
+        }
+
+    def jwks(self):
+        jwk = json.loads(RSAAlgorithm.to_jwk(self._key.public_key()))
+        jwk.update(kid=self._kid, alg='RS256', use='sig')
+        return {'keys': [jwk]}
+
+    def _claims(self, name, audience, lifetime):
+        now = int(time.time())
+        return {
+            'iss': self.issuer,
+            'aud': audience,
+            'sub': name,
+            'iat': now,
+            'exp': now + lifetime,
+            'jti': secrets.token_hex(8),
+            'preferred_username': name,
+            'resource_access': {self.client_id: {'roles': self.roles}},
+        }
+
+    def _tokens(self, name):
+        """Response of the authorization_code and refresh_token grants"""
+        access_token = jwt.encode(
+            self._claims(name, self.client_id, self.access_lifetime),
+            self._key,
+            algorithm='RS256',
+            headers={'kid': self._kid},
+        )
+        refresh_claims = self._claims(name, self.issuer, 1800)
+        refresh_claims['typ'] = 'Refresh'
+        refresh_token = jwt.encode(refresh_claims, self._hmac_secret, algorithm='HS256')
+        return {
+            'access_token': access_token,
+            'expires_in': self.access_lifetime,
+            'refresh_token': refresh_token,
+            'refresh_expires_in': 1800,
+            'token_type': 'Bearer',
+            'scope': 'openid profile email',
+        }
+
+    def token(self, grant_type, arguments):
+        if grant_type == 'authorization_code':
+            return self._tokens(arguments['code'])
+        if grant_type == 'refresh_token':
+            claims = jwt.decode(arguments['refresh_token'], self._hmac_secret, algorithms=['HS256'], audience=self.issuer)
+            return self._tokens(claims['sub'])
+        if grant_type == TOKEN_EXCHANGE:
+            name = jwt.decode(arguments['subject_token'], options={'verify_signature': False})['sub']
+            audience = arguments['audience']
+            if (name, audience) not in self._exchanged:
+                self._exchanged[(name, audience)] = jwt.encode(
+                    self._claims(name, audience, self.exchanged_lifetime), self._hmac_secret, algorithm='HS256'
+                )
+            return {
+                'access_token': self._exchanged[(name, audience)],
+                'expires_in': self.exchanged_lifetime,
+                'token_type': 'Bearer',
+            }
+        raise web.HTTPError(400, 'unsupported_grant_type')
+
+    def userinfo(self, access_token):
+        claims = jwt.decode(access_token, options={'verify_signature': False})
+        return {'sub': claims['sub'], 'preferred_username': claims['preferred_username']}
+
+    def make_app(self):
+        settings = dict(keycloak=self)
+        base = r'/realms/[^/]+'
+        return web.Application(
+            [
+                (base + r'/\.well-known/openid-configuration', _DiscoveryHandler),
+                (base + r'/protocol/openid-connect/certs', _CertsHandler),
+                (base + r'/protocol/openid-connect/token', _TokenHandler),
+                (base + r'/protocol/openid-connect/userinfo', _UserInfoHandler),
+                (r'/stats', _StatsHandler),
+            ],
+            **settings
+        )
+
+    def listen(self, port=0, address='127.0.0.1', realm='swan'):
+        """Start serving in the current IOLoop, returns the issuer URL"""
+        sockets = bind_sockets(port, address)
+        self._server = HTTPServer(self.make_app())
+        self._server.add_sockets(sockets)
+        port = sockets[0].getsockname()[1]
+        self.issuer = 'http://%s:%i/realms/%s' % (address, port, realm)
+        return self.issuer
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+
+class _Handler(web.RequestHandler):
+    @property
+    def keycloak(self):
+        return self.settings['keycloak']
+
+    async def prepare(self):
+        if self.keycloak.latency:
+            await asyncio.sleep(self.keycloak.latency)
+
+
+class _DiscoveryHandler(_Handler):
+    def get(self):
+        self.keycloak.requests['discovery'] += 1
+        self.write(self.keycloak.discovery())
+
+
+class _CertsHandler(_Handler):
+    def get(self):
+        self.keycloak.requests['certs'] += 1
+        self.write(self.keycloak.jwks())
+
+
+class _TokenHandler(_Handler):
+    def post(self):
+        arguments = {name: self.get_body_argument(name) for name in self.request.body_arguments}
+        grant_type = arguments.get('grant_type', '')
+        self.keycloak.requests['token ' + grant_type.rpartition(':')[2]] += 1
+        self.write(self.keycloak.token(grant_type, arguments))
+
+
+class _UserInfoHandler(_Handler):
+    def get(self):
+        self.keycloak.requests['userinfo'] += 1
+        _, _, access_token = self.request.headers.get('Authorization', '').partition(' ')
+        self.write(self.keycloak.userinfo(access_token))
+
+
+class _StatsHandler(web.RequestHandler):
+    def get(self):
+        self.write(dict(self.settings['keycloak'].requests))
@@ -4,11 +4,15 @@
 """KeyCloakAuthenticator"""
 from jupyterhub.utils import maybe_future
 from oauthenticator.generic import GenericOAuthenticator
-from traitlets import Unicode, Bool, List, Any, TraitError, default, validate
-import jwt, time, json
-from jwt.algorithms import RSAAlgorithm
+from tornado.httpclient import HTTPClientError, HTTPRequest
+from tornado.ioloop import IOLoop
+from traitlets import Unicode, Bool, List, Any, Float, Int, TraitError, default, validate
+import asyncio, heapq, jwt, os, time, json
+from datetime import timezone
 from urllib import request, parse
-from urllib.error import HTTPError
+from .cache import VerifiedTokenCache
+from .jwks import JWKSCache
+from .metrics import PROACTIVE_REFRESHES, REFRESH_COALESCED, TOKEN_CACHE, TOKEN_EXCHANGE_DURATION, TOKEN_EXCHANGES
 
 class KeyCloakAuthenticator(GenericOAuthenticator):
     """KeyCloakAuthenticator based on upstream jupyterhub/oauthenticator"""
@@ -19,6 +23,24 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
         help="OIDC issuer URL for automatic discovery of configuration"
     )
 
+    oidc_cache_path = Unicode(
+        default_value='',
+        config=True,
+        help="""
+            File where the OIDC configuration and signing keys are cached, to start the hub without waiting for the issuer
+            (empty to disable, the default). Use an absolute path, writable by the hub.
+        """
+    )
+
+    oidc_cache_ttl = Int(
+        default_value=86400,
+        config=True,
+        help="""
+            Seconds during which the cached OIDC configuration is used at startup, and revalidated in the background.
+            Older caches are only used when the issuer can't be reached.
+        """
+    )
+
     enable_logout = Bool(
         default_value=True,
         config=True,
@@ -82,6 +104,81 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
         help="List of audiences to exchange our token to"
     )
 
+    exchange_tokens_margin = Int(
+        config=True,
+        help="""
+            On refresh, the exchanged tokens that expire in less than these seconds are exchanged again, the others are kept.
+            By default, auth_refresh_age plus one minute, so that the tokens don't expire before the next refresh.
+        """
+    )
+
+    @default('exchange_tokens_margin')
+    def _default_exchange_tokens_margin(self):
+        return self.auth_refresh_age + 60
+
+    jwks_cache_ttl = Int(
+        default_value=3600,
+        config=True,
+        help="Seconds after which the signing keys (JWKS) are fetched again in the background, to follow key rotations"
+    )
+
+    jwks_min_refresh_interval = Int(
+        default_value=60,
+        config=True,
+        help="Minimum seconds between two fetches of the signing keys, also when tokens are signed with an unknown key"
+    )
+
+    token_cache_size = Int(
+        default_value=1024,
+        config=True,
+        help="Number of verified tokens whose claims are kept until they expire, to skip checking their signature again (0 to disable)"
+    )
+
+    proactive_refresh = Bool(
+        default_value=False,
+        config=True,
+        help="If True, the tokens of the active users are refreshed in the background before the access token expires, instead of during their requests"
+    )
+
+    proactive_refresh_margin = Int(
+        default_value=60,
+        config=True,
+        help="Seconds before the expiration of the access token when it's refreshed in the background"
+    )
+
+    proactive_refresh_batch = Int(
+        default_value=20,
+        config=True,
+        help="Maximum number of users refreshed together in the background, every proactive_refresh_interval seconds"
+    )
+
+    proactive_refresh_interval = Float(
+        default_value=1,
+        config=True,
+        help="Seconds between two batches of background refreshes"
+    )
+
+    proactive_refresh_max_idle = Int(
+        default_value=3600,
+        config=True,
+        help="Users without running servers and without activity for more than these seconds are no longer refreshed in the background"
+    )
+
+    token_request_timeout = Float(
+        default_value=10,
+        config=True,
+        help="Timeout (in seconds) of each request to the token endpoint (refresh and exchange of the tokens)"
+    )
+
+    @default('http_client')
+    def _default_http_client(self):
+        # Prefer curl, which keeps the connections to the token endpoint alive between requests
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+        except ImportError:
+            return super()._default_http_client()
+        return CurlAsyncHTTPClient(force_instance=True, defaults=dict(validate_cert=self.tls_verify))
+
     @validate('pre_spawn_hook')
     def _validate_pre_spawn_hook(self, proposal):
         value = proposal['value']
@@ -111,40 +208,125 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
         # Force auth state so that we can store the tokens in the user dict
         self.enable_auth_state = True
         self._allowed_roles = set(self.allowed_roles)
+        self._jwks = None
+        self._token_cache = VerifiedTokenCache(self.token_cache_size)
+        # refresh in progress, by user name
+        self._refreshing = {}
+        # (time, user name) of the next background refreshes, and the current one of every user
+        self._refresh_queue = []
+        self._refresh_due = {}
+        if self.proactive_refresh:
+            IOLoop.current().add_callback(self._proactive_refresh_loop)
+        # configured value, before adding the end session endpoint
+        self._logout_redirect_url = self.logout_redirect_url
 
         if not self.oidc_issuer:
             raise Exception('No OIDC issuer url provided')
 
-        self.log.info('Configuring OIDC from %s' % self.oidc_issuer)
+        cached = self._read_oidc_cache()
+        if cached and time.time() - cached['fetched'] < self.oidc_cache_ttl:
+            self.log.info('Configuring OIDC from the cache %s' % self.oidc_cache_path)
+            self._configure_oidc(cached['configuration'], cached['jwks'])
+        else:
+            self.log.info('Configuring OIDC from %s' % self.oidc_issuer)
+            try:
+                configuration, jwk_data = self._fetch_oidc()
+            except (OSError, ValueError):
+                if not cached:
+                    self.log.error("Failure to retrieve the openid configuration")
+                    raise
+                self.log.warning("Failure to retrieve the openid configuration, using the expired cache %s" % self.oidc_cache_path,
+                    exc_info=True)
+                self._configure_oidc(cached['configuration'], cached['jwks'])
+            else:
+                self._configure_oidc(configuration, jwk_data)
+                self._write_oidc_cache(configuration, jwk_data)
+                return
+
+        # Started from the cache, check it once the hub is running
+        IOLoop.current().add_callback(self._revalidate_oidc)
+
+    def _configure_oidc(self, data, jwk_data):
+        if not set(['authorization_endpoint', 'token_endpoint', 'userinfo_endpoint']).issubset(data.keys()):
+            raise Exception('Unable to retrieve OIDC necessary values')
+
+        self.authorize_url = data['authorization_endpoint']
+        self.token_url = data['token_endpoint']
+        self.userdata_url = data['userinfo_endpoint']
+
+        end_session_url = data.get('end_session_endpoint')
+        if self.enable_logout and end_session_url:
+            if self._logout_redirect_url:
+                end_session_url += '?redirect_uri=%s' % self._logout_redirect_url
+            # Update parent class OAuthenticator.logout_redirect_url
+            self.logout_redirect_url = end_session_url
+
+        if jwk_data is not None:
+            if self._jwks is None:
+                self._jwks = JWKSCache(data['jwks_uri'], self.fetch, self.log, ttl=self.jwks_cache_ttl,
+                        min_refresh_interval=self.jwks_min_refresh_interval,
+                        request_timeout=self.token_request_timeout)
+            else:
+                self._jwks.jwks_uri = data['jwks_uri']
+            self._jwks.load(jwk_data)
+
+    def _fetch_oidc(self):
+        # Blocking, only when starting without a valid cache
+        with request.urlopen('%s/.well-known/openid-configuration' % self.oidc_issuer,
+                timeout=self.token_request_timeout) as response:
+            data = json.loads(response.read())
+
+        jwk_data = None
+        if self.config.check_signature :
+            jwks_uri = data['jwks_uri']
+            with request.urlopen(jwks_uri, timeout=self.token_request_timeout) as jkws_response:
+                jwk_data = json.loads(jkws_response.read())
+                self.log.info('aquired public keys from %s' % jwks_uri)
+        return data, jwk_data
+
+    async def _revalidate_oidc(self):
+        try:
+            data = await self.fetch(HTTPRequest('%s/.well-known/openid-configuration' % self.oidc_issuer,
+                    request_timeout=self.token_request_timeout), 'fetching the openid configuration')
+            jwk_data = None
+            if self.config.check_signature :
+                jwk_data = await self.fetch(HTTPRequest(data['jwks_uri'],
+                        request_timeout=self.token_request_timeout), 'fetching the JWKS')
+            self._configure_oidc(data, jwk_data)
+        except Exception:
+            self.log.warning("Failure to revalidate the openid configuration, using the cached one", exc_info=True)
+            return
+        self._write_oidc_cache(data, jwk_data)
+        self.log.info('OIDC configuration revalidated from %s' % self.oidc_issuer)
+
+    def _read_oidc_cache(self):
+        if not self.oidc_cache_path:
+            return None
+        try:
+            with open(self.oidc_cache_path) as f:
+                cached = json.load(f)
+            if cached['issuer'] != self.oidc_issuer or not isinstance(cached['fetched'], (int, float)):
+                return None
+            if cached['jwks'] is None and self.config.check_signature:
+                return None
+            return cached
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError):
+            self.log.warning("Ignoring the invalid OIDC cache %s" % self.oidc_cache_path, exc_info=True)
+            return None
 
+    def _write_oidc_cache(self, data, jwk_data):
+        if not self.oidc_cache_path:
+            return
+        cached = dict(issuer=self.oidc_issuer, fetched=time.time(), configuration=data, jwks=jwk_data)
+        tmp_path = self.oidc_cache_path + '.tmp'
         try:
-            with request.urlopen('%s/.well-known/openid-configuration' % self.oidc_issuer) as response:
-                data = json.loads(response.read())
-
-                if not set(['authorization_endpoint', 'token_endpoint', 'userinfo_endpoint']).issubset(data.keys()):
-                    raise Exception('Unable to retrieve OIDC necessary values')
-
-                self.authorize_url = data['authorization_endpoint']
-                self.token_url = data['token_endpoint']
-                self.userdata_url = data['userinfo_endpoint']
-                
-                end_session_url = data.get('end_session_endpoint')
-                if self.enable_logout and end_session_url:
-                    if self.logout_redirect_url:
-                        end_session_url += '?redirect_uri=%s' % self.logout_redirect_url
-                    # Update parent class OAuthenticator.logout_redirect_url
-                    self.logout_redirect_url = end_session_url 
-
-                if self.config.check_signature :
-                    jwks_uri = data['jwks_uri']
-                    with request.urlopen(jwks_uri) as jkws_response:
-                        jwk_data = json.loads(jkws_response.read())
-                        self.public_key = RSAAlgorithm(RSAAlgorithm.SHA256).from_jwk(jwk_data['keys'][0])
-                        self.log.info('aquired public key from %s' % jwks_uri)
-
-        except HTTPError:
-            self.log.error("Failure to retrieve the openid configuration")
-            raise
+            with open(tmp_path, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, self.oidc_cache_path)
+        except OSError:
+            self.log.warning("Failure to write the OIDC cache %s" % self.oidc_cache_path, exc_info=True)
 
 
     def _validate_roles(self, user_roles):
@@ -152,55 +334,107 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
             (self._allowed_roles & user_roles)
 
     def _decode_token(self, token, options={}):
+        options = dict(options)
         if not self.config.check_signature:
             options.update({"verify_signature": False})
         #if not explicitly disabled, verify issuer
         options.setdefault("verify_iss", True)
 
+        key = None
+        verify = self._jwks is not None and options.get("verify_signature", True)
+        if verify:
+            decoded_token = self._token_cache.get(token, options)
+            if decoded_token is not None:
+                TOKEN_CACHE.labels('hit').inc()
+                return decoded_token
+            TOKEN_CACHE.labels('miss').inc()
+            # pick the key from the kid of the token, unknown kids trigger a (rate limited) refresh of the keys
+            key = self._jwks.key_for(token)
+
         try:
-            decoded_token = jwt.decode(token, self.public_key, options=options, audience=self.client_id,
+            decoded_token = jwt.decode(token, key, options=options, audience=self.client_id,
                     issuer=self.oidc_issuer, algorithms=self.jwt_signing_algorithms)
+            if verify:
+                self._token_cache.put(token, options, decoded_token)
             return decoded_token
         except jwt.exceptions.ExpiredSignatureError:
             self.log.info("Token expired")
             return None
 
-    def _exchange_tokens(self, token):
-
-        tokens = dict()
-
-        for new_token in self.exchange_tokens:
+    async def _prepare_key(self, token):
+        # fetch the keys again before decoding a token signed with a key we don't know yet
+        if self._jwks is not None:
+            await self._jwks.prepare(token)
+
+    async def _token_request(self, values, label):
+        req = HTTPRequest(
+            self.token_url,
+            method='POST',
+            headers={'Accept': 'application/json'},
+            body=parse.urlencode(values),
+            request_timeout=self.token_request_timeout
+        )
+        return await self.fetch(req, label)
 
-            values = dict(
-                grant_type = 'urn:ietf:params:oauth:grant-type:token-exchange',
-                client_id = self.client_id,
-                client_secret = self.client_secret,
-                subject_token = token,
-                audience = new_token,
-                requested_token_type = 'urn:ietf:params:oauth:token-type:access_token'
-            )
-            data = parse.urlencode(values).encode('ascii')
+    async def _exchange_token(self, token, audience):
+        values = dict(
+            grant_type = 'urn:ietf:params:oauth:grant-type:token-exchange',
+            client_id = self.client_id,
+            client_secret = self.client_secret,
+            subject_token = token,
+            audience = audience,
+            requested_token_type = 'urn:ietf:params:oauth:token-type:access_token'
+        )
+        start = time.perf_counter()
+        try:
+            data = await self._token_request(values, 'exchanging token for %s' % audience)
+        finally:
+            TOKEN_EXCHANGE_DURATION.labels(audience).observe(time.perf_counter() - start)
+        TOKEN_EXCHANGES.labels(audience, 'exchanged').inc()
+        expires_in = data.get('expires_in')
+        return data.get('access_token', None), (time.time() + expires_in if expires_in else None)
+
+    async def _exchange_tokens(self, token, auth_state=None):
+        """
+            Exchange the token for all the audiences in exchange_tokens.
+            With the auth_state of a previous exchange, the tokens still valid for more than
+            exchange_tokens_margin seconds are kept.
+            Returns the tokens and their expiration time (None if unknown), by audience.
+        """
+        auth_state = auth_state or {}
+        previous_tokens = auth_state.get('exchanged_tokens') or {}
+        previous_expiry = auth_state.get('exchanged_tokens_expiry') or {}
+        renew_before = time.time() + self.exchange_tokens_margin
 
-            req = request.Request(self.token_url, data)
-            with request.urlopen(req) as response:
-                data = json.loads(response.read())
-                tokens[new_token] = data.get('access_token', None)
+        tokens = dict()
+        expiry = dict()
+        audiences = []
+        for audience in self.exchange_tokens:
+            if previous_tokens.get(audience) and (previous_expiry.get(audience) or 0) > renew_before:
+                tokens[audience] = previous_tokens[audience]
+                expiry[audience] = previous_expiry[audience]
+                TOKEN_EXCHANGES.labels(audience, 'reused').inc()
+            else:
+                audiences.append(audience)
 
-        return tokens
+        # All the audiences are exchanged at the same time
+        new_tokens = await asyncio.gather(
+            *[self._exchange_token(token, audience) for audience in audiences]
+        )
+        for audience, (new_token, expires_at) in zip(audiences, new_tokens):
+            tokens[audience] = new_token
+            expiry[audience] = expires_at
+        return tokens, expiry
 
-    def _refresh_token(self, refresh_token):
+    async def _refresh_token(self, refresh_token):
         values = dict(
             grant_type = 'refresh_token',
             client_id = self.client_id,
             client_secret = self.client_secret,
             refresh_token = refresh_token
         )
-        data = parse.urlencode(values).encode('ascii')
-
-        req = request.Request(self.token_url, data)
-        with request.urlopen(req) as response:
-            data = json.loads(response.read())
-            return (data.get('access_token', None), data.get('refresh_token', None))
+        data = await self._token_request(values, 'refreshing token')
+        return (data.get('access_token', None), data.get('refresh_token', None))
 
     async def authenticate(self, handler, data=None):
         user = await super().authenticate(handler, data=data)
@@ -208,6 +442,7 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
             return None
 
         try:
+            await self._prepare_key(user['auth_state']['access_token'])
             decoded_token = self._decode_token(user['auth_state']['access_token'])
             user_roles = self.claim_roles_key(self, decoded_token)
         except:
@@ -222,12 +457,14 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
             self.log.info(f"User '{user['name']}' doesn't have apropriate role to be allowed")
             return None
         try:
-            user['auth_state']['exchanged_tokens'] = self._exchange_tokens(user['auth_state']['access_token'])
+            user['auth_state']['exchanged_tokens'], user['auth_state']['exchanged_tokens_expiry'] = \
+                await self._exchange_tokens(user['auth_state']['access_token'])
         except:
             self.log.error("Failed to exchange tokens during authenticate.", exc_info=True)
             return None
 
         user['admin'] = self.admin_role and (self.admin_role in user_roles)
+        self._schedule_refresh(user['name'], decoded_token)
         self.log.info("Authentication Successful for user: %s, roles: %s, admin: %s" % (user['name'], user_roles, user['admin']))
 
         return user
@@ -243,8 +480,27 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
             Refresh user's oAuth tokens.
             This is called when user info is requested and
             has passed more than "auth_refresh_age" seconds.
+            Concurrent calls for the same user (e.g. from several tabs) share the same refresh,
+            as Keycloak rotates the refresh token.
+            The new tokens are saved before the next call can start a refresh, which then
+            reads them, so True is returned: the auth_state of the user is already up-to-date.
         """
-
+        refreshing = self._refreshing.get(user.name)
+        if refreshing is not None:
+            REFRESH_COALESCED.inc()
+        else:
+            refreshing = asyncio.ensure_future(self._refresh_user(user))
+            self._refreshing[user.name] = refreshing
+            refreshing.add_done_callback(lambda f: self._refreshing.pop(user.name, None))
+
+        # the refresh goes on if one of the callers is cancelled
+        result = await asyncio.shield(refreshing)
+        if not result:
+            # the user needs to login again, nothing to refresh in the background
+            self._refresh_due.pop(user.name, None)
+        return result
+
+    async def _refresh_user(self, user):
         try:
             # Retrieve user authentication info, decode, and check if refresh is needed
             auth_state = await user.get_auth_state()
@@ -262,26 +518,74 @@ class KeyCloakAuthenticator(GenericOAuthenticator):
 
             else:
                 # We need to refresh access token (which will also refresh the refresh token)
-                access_token, refresh_token = self._refresh_token(auth_state['refresh_token'])
+                access_token, refresh_token = await self._refresh_token(auth_state['refresh_token'])
                 #check signature for new access token, if it fails we catch in the exception below
-                self._decode_token(access_token)
+                await self._prepare_key(access_token)
+                decoded_token = self._decode_token(access_token)
                 auth_state['access_token'] = access_token
                 auth_state['refresh_token'] = refresh_token
                 try:
-                    auth_state['exchanged_tokens'] = self._exchange_tokens(access_token)
+                    auth_state['exchanged_tokens'], auth_state['exchanged_tokens_expiry'] = \
+                        await self._exchange_tokens(access_token, auth_state)
                 except:
                     self.log.error("Failed to exchange tokens during refresh.", exc_info=True)
                     return False
 
+                # saved while the refresh is still shared, so that no call reads the rotated refresh token
+                await user.save_auth_state(auth_state)
                 self.log.info('User %s oAuth tokens refreshed' % user.name)
-                return {
-                    'auth_state': auth_state
-                }
+                self._schedule_refresh(user.name, decoded_token)
+                return True
 
-        except HTTPError as e:
-            self.log.error("Failure calling the renew endpoint: %s (code: %s)" % (e.read(), e.code))
+        except HTTPClientError as e:
+            # the response was already logged by fetch
+            self.log.error("Failure calling the renew endpoint (code: %s)" % e.code)
 
         except:
             self.log.error("Failed to refresh the oAuth tokens", exc_info=True)
 
         return False
+
+    def _schedule_refresh(self, name, decoded_token):
+        if not self.proactive_refresh or not decoded_token or 'exp' not in decoded_token:
+            return
+        due = decoded_token['exp'] - self.proactive_refresh_margin
+        self._refresh_due[name] = due
+        heapq.heappush(self._refresh_queue, (due, name))
+
+    async def _proactive_refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.proactive_refresh_interval)
+            now = time.time()
+            names = []
+            while self._refresh_queue and self._refresh_queue[0][0] <= now and len(names) < self.proactive_refresh_batch:
+                due, name = heapq.heappop(self._refresh_queue)
+                # skip the entries replaced by a later schedule of the same user
+                if self._refresh_due.get(name) == due:
+                    del self._refresh_due[name]
+                    names.append(name)
+            if names:
+                await asyncio.gather(*[self._proactive_refresh(name) for name in names])
+
+    async def _proactive_refresh(self, name):
+        try:
+            user = self.parent.users[name]
+            last_activity = user.last_activity
+            idle = time.time() - last_activity.replace(tzinfo=timezone.utc).timestamp() if last_activity else None
+            if not user.active and (idle is None or idle > self.proactive_refresh_max_idle):
+                PROACTIVE_REFRESHES.labels('inactive').inc()
+                return
+
+            result = await self.refresh_user(user)
+            if not result:
+                PROACTIVE_REFRESHES.labels('failed').inc()
+                return
+            # the requests of the user don't need to refresh again for auth_refresh_age seconds
+            user._auth_refreshed = time.monotonic()
+            PROACTIVE_REFRESHES.labels('refreshed').inc()
+        except KeyError:
+            # user deleted
+            PROACTIVE_REFRESHES.labels('inactive').inc()
+        except:
+            self.log.error("Failed to refresh the oAuth tokens of %s in the background" % name, exc_info=True)
+            PROACTIVE_REFRESHES.labels('failed').inc()
@@ -0,0 +1,44 @@
+"""Cache of the claims of the tokens already verified"""
+from collections import OrderedDict
+import hashlib, time
+
+class VerifiedTokenCache(object):
+    """
+        LRU cache of the claims of the decoded tokens, by digest of the token and decode options.
+        An entry expires with its token (exp claim), tokens without expiration are not cached.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._entries = OrderedDict()
+
+    def _key(self, token, options):
+        return (hashlib.sha256(token.encode('utf-8')).digest(), frozenset(options.items()))
+
+    def get(self, token, options):
+        """Claims of the token, or None if not cached or expired"""
+        key = self._key(token, options)
+        claims = self._entries.get(key)
+        if claims is None:
+            return None
+        if claims['exp'] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        # callers can change the claims they get, not the cached ones
+        return dict(claims)
+
+    def put(self, token, options, claims):
+        if self.size <= 0 or not isinstance(claims.get('exp'), (int, float)):
+            return
+        key = self._key(token, options)
+        self._entries[key] = dict(claims)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,110 @@
+"""Cache of the keys published by the OIDC provider (JWKS)"""
+import asyncio, time
+import jwt
+from tornado.httpclient import HTTPRequest
+
+class JWKSCache(object):
+    """
+        Keys of the JWKS, indexed by kid, to check the signature of the tokens.
+        The keys are refreshed in the background once they are older than ttl seconds,
+        or when a token is signed with an unknown kid (e.g. after a key rotation).
+        There is at most one request to the jwks_uri every min_refresh_interval seconds,
+        so that tokens with forged kids can't flood the provider.
+    """
+
+    def __init__(self, jwks_uri, fetch, log, ttl=3600, min_refresh_interval=60, request_timeout=10):
+        self.jwks_uri = jwks_uri
+        self.log = log
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.request_timeout = request_timeout
+        self._fetch = fetch
+        self._keys = {}
+        # key used for the tokens without kid, the first one published
+        self._default_key = None
+        self._loaded = 0
+        self._last_fetch = 0
+        self._refreshing = None
+
+    def load(self, jwk_data):
+        """Replace the keys with the ones in the JWKS document"""
+        keys = {}
+        default_key = None
+        for jwk in jwk_data.get('keys', []):
+            if jwk.get('use', 'sig') != 'sig':
+                continue
+            try:
+                key = jwt.PyJWK(jwk).key
+            except jwt.exceptions.PyJWKError as e:
+                self.log.debug("Skipping key %s of the JWKS: %s" % (jwk.get('kid'), e))
+                continue
+            keys[jwk.get('kid')] = key
+            if default_key is None:
+                default_key = key
+        if default_key is None:
+            raise ValueError('No signing key in the JWKS')
+        self._keys = keys
+        self._default_key = default_key
+        self._loaded = time.monotonic()
+
+    def get(self, kid):
+        """Key with this kid (the default key for None), or None if unknown"""
+        if time.monotonic() - self._loaded > self.ttl:
+            self.refresh_in_background()
+        if kid is None:
+            return self._default_key
+        return self._keys.get(kid)
+
+    def key_for(self, token):
+        """Key to check the signature of the token, as given by the kid in its header"""
+        kid = jwt.get_unverified_header(token).get('kid')
+        key = self.get(kid)
+        if key is None:
+            self.refresh_in_background()
+            raise jwt.exceptions.InvalidKeyError('Unknown signing key: %s' % kid)
+        return key
+
+    async def prepare(self, token):
+        """Make sure that the key of the token is known, fetching the JWKS again if needed"""
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+        except jwt.exceptions.DecodeError:
+            return
+        if kid is not None and kid not in self._keys:
+            await self.refresh()
+
+    def refresh_in_background(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # nowhere to run the refresh, e.g. decoding a token from a script
+            return
+        if self._refreshing is None and self._can_fetch():
+            asyncio.ensure_future(self.refresh())
+
+    def _can_fetch(self):
+        return time.monotonic() - self._last_fetch >= self.min_refresh_interval
+
+    async def refresh(self):
+        """Fetch the JWKS again, unless it was fetched less than min_refresh_interval seconds ago"""
+        if self._refreshing is not None:
+            # share the request in progress
+            return await self._refreshing
+        if not self._can_fetch():
+            return
+        self._last_fetch = time.monotonic()
+        self._refreshing = asyncio.ensure_future(self._refresh())
+        try:
+            await self._refreshing
+        finally:
+            self._refreshing = None
+
+    async def _refresh(self):
+        try:
+            req = HTTPRequest(self.jwks_uri, headers={'Accept': 'application/json'},
+                    request_timeout=self.request_timeout)
+            self.load(await self._fetch(req, 'fetching the JWKS'))
+            self.log.info('Refreshed the JWKS from %s (keys: %s)' % (self.jwks_uri, ', '.join(map(str, self._keys))))
+        except Exception:
+            # keep using the keys we have
+            self.log.error('Failure refreshing the JWKS from %s' % self.jwks_uri, exc_info=True)
@@ -0,0 +1,31 @@
+"""Prometheus metrics of the authenticator, exposed with the ones of JupyterHub in /hub/metrics"""
+from prometheus_client import Counter, Histogram
+
+TOKEN_CACHE = Counter(
+    'keycloakauthenticator_token_cache',
+    'Tokens decoded from the cache of verified tokens (hit) or verified again (miss)',
+    ['result']
+)
+
+TOKEN_EXCHANGE_DURATION = Histogram(
+    'keycloakauthenticator_token_exchange_duration_seconds',
+    'Time taken to exchange a token, by audience',
+    ['audience']
+)
+
+TOKEN_EXCHANGES = Counter(
+    'keycloakauthenticator_token_exchanges',
+    'Exchanged tokens, requested again (exchanged) or still valid and kept on refresh (reused), by audience',
+    ['audience', 'result']
+)
+
+REFRESH_COALESCED = Counter(
+    'keycloakauthenticator_refresh_coalesced',
+    'Calls to refresh_user that waited for the refresh of the same user already in progress'
+)
+
+PROACTIVE_REFRESHES = Counter(
+    'keycloakauthenticator_proactive_refreshes',
+    'Users refreshed in the background before their access token expires (refreshed, failed), or no longer refreshed (inactive)',
+    ['result']
+)
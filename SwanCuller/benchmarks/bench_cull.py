@@ -0,0 +1,138 @@
+"""Cycle time and peak memory of the culler with many users
+
+Starts a stand-in Hub with synthetic users (all of them with a running,
+active server, so that every cycle evaluates them all without culling any)
+in a separate process, and runs one culling cycle per run in a fresh process,
+reporting its duration and the peak RSS of that process:
+
+    python benchmarks/bench_cull.py --users 10000,50000,100000
+
+Each size runs with the current code and with the previous timestamp parsing
+(dateutil only) and eager formatting of the debug logs, to show the gains.
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import dateutil.parser
+from tornado.ioloop import IOLoop
+
+from swanculler import app
+from swanculler.fakehub import FakeHub
+
+
+def _isoformat(dt):
+    return dt.isoformat().replace('+00:00', 'Z')
+
+
+def _users(n):
+    now = datetime.now(timezone.utc)
+    users = {}
+    for i in range(n):
+        name = 'user%i' % i
+        users[name] = {
+            'name': name,
+            'admin': False,
+            'created': _isoformat(now - timedelta(days=30)),
+            'last_activity': _isoformat(now - timedelta(seconds=i % 300)),
+            'servers': {
+                '': {
+                    'name': '',
+                    'ready': True,
+                    'pending': None,
+                    'url': '/user/%s/' % name,
+                    'started': _isoformat(now - timedelta(hours=1, seconds=i % 3600)),
+                    'last_activity': _isoformat(now - timedelta(seconds=i % 300)),
+                }
+            },
+        }
+    return users
+
+
+def _serve(n_users, queue):
+    hub = FakeHub(_users(n_users))
+    queue.put(hub.listen())
+    IOLoop.current().start()
+
+
+def _dateutil_parse_date(date_string):
+    dt = dateutil.parser.parse(date_string)
+    if not dt.tzinfo:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def _run_cycle(url, variant, paginate, concurrency):
+    """Run one cycle in this process, print its duration and peak RSS"""
+    if variant == 'baseline':
+        app.parse_date = _dateutil_parse_date
+        app.LazyTd = app.format_td
+
+    async def cycle():
+        start = time.perf_counter()
+        await app.cull_idle(
+            url, 'benchmark', inactive_limit=3600, concurrency=concurrency, paginate=paginate
+        )
+        return time.perf_counter() - start
+
+    duration = IOLoop.current().run_sync(cycle)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    print(json.dumps({'duration': duration, 'rss_mb': rss / 1024}))
+
+
+def _bench_parse_date(n=100000):
+    timestamps = [_isoformat(datetime.now(timezone.utc) - timedelta(seconds=i)) for i in range(n)]
+    results = {}
+    for name, parse in (('dateutil', _dateutil_parse_date), ('fast path', app.parse_date)):
+        start = time.perf_counter()
+        for timestamp in timestamps:
+            parse(timestamp)
+        results[name] = 1e6 * (time.perf_counter() - start) / n
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', default='10000,50000,100000', help="Comma-separated numbers of users")
+    parser.add_argument('--paginate', action='store_true', help="Request the users page by page")
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--run-cycle', nargs=2, metavar=('URL', 'VARIANT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_cycle:
+        return _run_cycle(*args.run_cycle, paginate=args.paginate, concurrency=args.concurrency)
+
+    for name, usec in _bench_parse_date().items():
+        print("parse_date %-10s %8.2f us" % (name, usec))
+    print()
+    print("%-10s %-10s %12s %14s" % ('users', 'variant', 'cycle (s)', 'peak RSS (MB)'))
+    for n_users in (int(n) for n in args.users.split(',')):
+        queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=_serve, args=(n_users, queue), daemon=True)
+        server.start()
+        url = queue.get()
+        try:
+            for variant in ('baseline', 'current'):
+                command = [sys.executable, __file__, '--run-cycle', url, variant]
+                command += ['--concurrency', str(args.concurrency)]
+                if args.paginate:
+                    command.append('--paginate')
+                output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+                result = json.loads(output.decode().strip().splitlines()[-1])
+                print(
+                    "%-10i %-10s %12.2f %14.1f"
+                    % (n_users, variant, result['duration'], result['rss_mb'])
+                )
+        finally:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
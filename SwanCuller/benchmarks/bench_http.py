@@ -0,0 +1,90 @@
+"""Requests per second to the Hub API with the different HTTP clients
+
+Starts a stand-in Hub with the given number of users in a separate process,
+and gets every user from it, as the culler does, with each client:
+
+    python benchmarks/bench_http.py --users 5000 --concurrency 10
+"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+
+from swanculler.fakehub import FakeHub
+from swanculler.hubclient import HubClient
+
+
+def _users(n):
+    return {
+        'user%i' % i: {
+            'name': 'user%i' % i,
+            'admin': False,
+            'last_activity': '2021-01-01T10:00:00.000000Z',
+            'servers': {},
+        }
+        for i in range(n)
+    }
+
+
+def _serve(n_users, queue):
+    hub = FakeHub(_users(n_users))
+    queue.put(hub.listen())
+    IOLoop.current().start()
+
+
+async def _run(client, url, n_users, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def get(i):
+        async with semaphore:
+            await client.fetch(
+                HTTPRequest(url + '/users/user%i' % i, headers={'Authorization': 'token benchmark'})
+            )
+
+    start = time.perf_counter()
+    await asyncio.gather(*(get(i) for i in range(n_users)))
+    return n_users / (time.perf_counter() - start)
+
+
+def _clients(concurrency):
+    yield 'tornado simple', lambda: AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    try:
+        from tornado.curl_httpclient import CurlAsyncHTTPClient
+    except ImportError:
+        pass
+    else:
+        yield 'tornado curl', lambda: CurlAsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    yield 'keep-alive pool', lambda: HubClient(max_connections=concurrency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args()
+
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_serve, args=(args.users, queue), daemon=True)
+    server.start()
+    url = queue.get()
+    try:
+        print("%-20s %10s" % ('client', 'req/s'))
+        for name, make_client in _clients(args.concurrency):
+
+            async def run():
+                client = make_client()
+                try:
+                    return await _run(client, url, args.users, args.concurrency)
+                finally:
+                    client.close()
+
+            print("%-20s %10.0f" % (name, IOLoop.current().run_sync(run)))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,9 @@ setup_args = dict(
           'tornado',
           'python-dateutil'
     ],
+    extras_require={
+        'metrics': ['prometheus_client'],
+    },
     zip_safe=False,
     include_package_data=True,
     license="AGPL-3.0",
@@ -0,0 +1,175 @@
+"""Activity pushed to the culler by the single-user servers or a sidecar
+
+The Hub only updates last_activity every last_activity_interval, plus the
+websocket ping interval, so its view of the activity lags behind. Servers
+can push their activity directly to the culler, with the same body as the
+Hub activity API (POST /users/:name/activity), and the culler uses the most
+recent of both.
+
+The single-user servers authenticate with their own Hub API token, and can
+only push the activity of their user. The shared token is only meant for
+trusted components (sidecars, SwanHub), never for the users' containers.
+"""
+import hashlib
+import hmac
+import json
+import time
+from datetime import datetime, timezone
+
+from tornado import web
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+from tornado.log import app_log
+
+from .metrics import ACTIVITY_PUSHES
+
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp, as sent by jupyterhub-singleuser"""
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if not dt.tzinfo:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+class ActivityIndex(object):
+    """Last activity pushed for every server, by user name and server name"""
+
+    def __init__(self):
+        self._activity = {}
+
+    def record(self, name, server_name, when):
+        servers = self._activity.setdefault(name, {})
+        if server_name not in servers or when > servers[server_name]:
+            servers[server_name] = when
+
+    def get(self, name, server_name):
+        return self._activity.get(name, {}).get(server_name)
+
+    def latest(self, name):
+        """Last activity of any server of the user"""
+        servers = self._activity.get(name)
+        return max(servers.values()) if servers else None
+
+    def forget(self, name, server_name):
+        servers = self._activity.get(name, {})
+        servers.pop(server_name, None)
+        if not servers:
+            self._activity.pop(name, None)
+
+    def prune(self, before):
+        """Forget the activity older than before, which can't change any decision"""
+        for name in list(self._activity):
+            servers = self._activity[name]
+            for server_name in [s for s, when in servers.items() if when < before]:
+                del servers[server_name]
+            if not servers:
+                del self._activity[name]
+
+    def __len__(self):
+        return sum(len(servers) for servers in self._activity.values())
+
+
+class TokenOwners(object):
+    """Name of the user of a Hub API token, as returned by the Hub (GET /user)
+
+    The answers of the Hub, also the rejected tokens, are kept for ttl
+    seconds (by digest of the token), so that every push doesn't cost a
+    request to the Hub.
+    """
+
+    def __init__(self, hub_url, ttl=300, max_size=10000, client=None):
+        self.hub_url = hub_url.rstrip('/')
+        self.ttl = ttl
+        self.max_size = max_size
+        self.client = client or AsyncHTTPClient()
+        # (user name or None, expiry time), by digest of the token
+        self._owners = {}
+
+    async def owner(self, token):
+        key = hashlib.sha256(token.encode('utf8')).digest()
+        now = time.monotonic()
+        cached = self._owners.get(key)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        req = HTTPRequest(url=self.hub_url + '/user', headers={'Authorization': 'token %s' % token})
+        try:
+            resp = await self.client.fetch(req)
+            model = json.loads(resp.body.decode('utf8', 'replace'))
+            # tokens of services can't speak for users
+            name = model.get('name') if model.get('kind', 'user') == 'user' else None
+        except HTTPClientError as e:
+            if e.code not in (401, 403):
+                raise
+            name = None
+        if len(self._owners) >= self.max_size:
+            self._owners = {k: v for k, v in self._owners.items() if v[1] > now}
+            if len(self._owners) >= self.max_size:
+                self._owners.clear()
+        self._owners[key] = (name, now + self.ttl)
+        return name
+
+
+class TokenHandler(web.RequestHandler):
+    """Requests about the user in the URL, in the header Authorization: token <token>
+
+    Authenticated with the shared token, or with a Hub API token of that
+    same user, e.g. the token of their single-user server.
+    """
+
+    async def prepare(self):
+        scheme, _, token = self.request.headers.get('Authorization', '').partition(' ')
+        token = token.strip()
+        if scheme.lower() != 'token' or not token:
+            raise web.HTTPError(403)
+        shared = self.settings.get('activity_token')
+        if shared and hmac.compare_digest(token.encode('utf8'), shared.encode('utf8')):
+            return
+        if self.settings.get('token_owners') is None:
+            # only the shared token is accepted
+            raise web.HTTPError(403)
+        try:
+            owner = await self.settings['token_owners'].owner(token)
+        except Exception as e:
+            app_log.error("Cannot check a token with the Hub: %s", e)
+            raise web.HTTPError(503)
+        if owner is None or owner != self.path_args[0]:
+            raise web.HTTPError(403)
+
+
+class ActivityHandler(TokenHandler):
+    """Receive the activity of a user's servers"""
+
+    def post(self, name):
+        try:
+            body = json.loads(self.request.body or b'{}')
+            now = datetime.now(timezone.utc)
+            servers = {
+                server_name: parse_timestamp(server['last_activity'])
+                for server_name, server in (body.get('servers') or {}).items()
+                if server.get('last_activity')
+            }
+            if body.get('last_activity') and not servers:
+                # only the activity of the user, e.g. from a sidecar of the default server
+                servers[''] = parse_timestamp(body['last_activity'])
+        except (ValueError, TypeError, AttributeError, KeyError):
+            raise web.HTTPError(400, "Invalid activity")
+
+        index = self.settings['activity']
+        for server_name, when in servers.items():
+            # a clock ahead of ours can't postpone the culling
+            index.record(name, server_name, min(when, now))
+        ACTIVITY_PUSHES.inc()
+        self.set_status(204)
+
+
+class ResumeHandler(TokenHandler):
+    """Resume the paused servers of a user, e.g. when the proxy can't reach them"""
+
+    async def post(self, name):
+        resumed = await self.settings['pause'].resume_user(name)
+        index = self.settings['activity']
+        if index is not None:
+            now = datetime.now(timezone.utc)
+            for server_name in resumed:
+                index.record(name, server_name, now)
+        self.write({'resumed': resumed})
@@ -32,37 +32,53 @@ users and servers, you should add this script to the services list
 twice, just with different ``name``s, different values, and one with
 the ``--cull-users`` option.
 """
+import asyncio
 import json
 import os
+import random
+import socket
+import sys
+import time
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 from functools import partial
 
 try:
-    from urllib.parse import quote
+    from urllib.parse import quote, urlencode
 except ImportError:
-    from urllib import quote
+    from urllib import quote, urlencode
 
 import dateutil.parser
 
-from tornado.gen import coroutine, multi
-from tornado.locks import Semaphore
+from tornado.locks import Lock, Semaphore
 from tornado.log import app_log
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
 from tornado.ioloop import IOLoop, PeriodicCallback
-from tornado.options import define, options, parse_command_line
+from tornado.options import Error as OptionsError, define, options, parse_command_line
+from tornado.web import Application
 
-# Start SWAN code
-from subprocess import call
-
-def check_ticket(username):
-    app_log.info("Checking ticket for user %s", username)
-    call(['sudo', "%s/check_ticket.sh" % options.hooks_dir, username])
-
-def delete_ticket(username):
-    app_log.info("Deleting ticket for user %s", username)
-    call(['sudo', "%s/delete_ticket.sh" % options.hooks_dir, username])
-# End SWAN code
+from .activity import ActivityHandler, ActivityIndex, ResumeHandler, TokenOwners
+from .hooks import TicketHooks
+from .hubclient import HubClient
+from .limiter import AdaptiveLimiter
+from .metrics import (
+    CULL_OUTCOMES,
+    CYCLE_DURATION,
+    HUB_REQUEST_DURATION,
+    HUB_REQUEST_QUEUE_DURATION,
+    PROBE_RESULTS,
+    SERVERS_EVALUATED,
+    USERS_EVALUATED,
+    MetricsHandler,
+    prometheus_client,
+)
+from .pause import PauseTier, load_pause_backend
+from .pressure import PressurePolicy, load_capacity_source, parse_resources, release, server_resources
+from .probes import load_probes, record as record_probe
+from .scheduler import DeadlineScheduler
+from .sharding import FileLeaseCoordinator
+from .state import StateStore
 
 def parse_date(date_string):
     """Parse a timestamp
@@ -71,7 +87,13 @@ def parse_date(date_string):
 
     Returned datetime object will always be timezone-aware
     """
-    dt = dateutil.parser.parse(date_string)
+    # fast path for the ISO 8601 timestamps of the Hub, e.g. 2021-01-01T10:00:00.123456Z
+    if date_string.endswith('Z'):
+        date_string = date_string[:-1] + '+00:00'
+    try:
+        dt = datetime.fromisoformat(date_string)
+    except ValueError:
+        dt = dateutil.parser.parse(date_string)
     if not dt.tzinfo:
         # assume naïve timestamps are UTC
         dt = dt.replace(tzinfo=timezone.utc)
@@ -96,40 +118,177 @@ def format_td(td):
     return "{h:02}:{m:02}:{seconds:02}".format(h=h, m=m, seconds=seconds)
 
 
-@coroutine
-def cull_idle(
-    url, api_token, inactive_limit, cull_users=False, disable_hooks=False, max_age=0, concurrency=10
+class LazyTd(object):
+    """format_td(td), only when the log message is emitted"""
+
+    __slots__ = ('td',)
+
+    def __init__(self, td):
+        self.td = td
+
+    def __str__(self):
+        return format_td(self.td)
+
+
+async def cull_idle(
+    url,
+    api_token,
+    inactive_limit,
+    cull_users=False,
+    hooks=None,
+    max_age=0,
+    concurrency=10,
+    limiter=None,
+    workers=0,
+    paginate=False,
+    page_size=200,
+    active_users=None,
+    usernames=None,
+    schedule=None,
+    slow_stops=None,
+    slow_stop_timeout=300,
+    owns=None,
+    client=None,
+    pressure=None,
+    activity=None,
+    pause=None,
+    probes=None,
+    now=None,
 ):
     """Shutdown idle single-user servers
 
     If cull_users, inactive *users* will be deleted as well.
+
+    hooks are the TicketHooks to run for every user (None to disable them).
+
+    limiter is an AdaptiveLimiter shared by the cycles, used instead of a
+    fixed concurrency.
+
+    workers is the number of users handled at the same time, by default
+    the (maximum) concurrency of the requests, or 100 without limit.
+
+    If paginate, users are requested page by page (jupyterhub >= 2.0),
+    only for users with active servers.
+    active_users is the set of users seen with active servers in the
+    previous paginated cycle, used to delete the tickets of users whose
+    servers were stopped outside of the culler.
+
+    If usernames is given, only those users are requested and handled.
+    schedule is called with the name of every user that still has servers
+    running and the time at which the user should be checked again
+    (None if unknown).
+
+    slow_stops is the set, shared by the cycles, of users whose servers are
+    slow to stop. If given, those servers are polled in the background for up
+    to slow_stop_timeout seconds, and the user is handled again (including
+    the ticket hooks) as soon as they stop.
+
+    owns is a function telling whether a username belongs to this culler,
+    when the users are split among several replicas. Other users are ignored.
+
+    pressure is a PressurePolicy. If given, full cycles check the free
+    capacity, and when it's low they also stop the idle servers with the
+    biggest footprint x idle time, until the capacity is recovered.
+
+    activity is an ActivityIndex with the activity pushed by the servers,
+    used when it's more recent than the one known by the Hub.
+
+    pause is a PauseTier. If given, servers inactive for pause.after seconds
+    are paused, resumed when they are active again, and culled after
+    inactive_limit seconds as usual.
+
+    probes are checked for every running server, and if they know its
+    activity, they take precedence over the Hub last_activity (see probes.py).
+
+    client is the HTTP client for the Hub API, a HubClient or tornado's
+    AsyncHTTPClient (the default).
+
+    now is the current time, given only when simulating.
     """
     auth_header = {'Authorization': 'token %s' % api_token}
-    req = HTTPRequest(url=url + '/users', headers=auth_header)
-    now = datetime.now(timezone.utc)
-    client = AsyncHTTPClient()
+    simulated = now is not None
+    if now is None:
+        now = datetime.now(timezone.utc)
+    if client is None:
+        client = AsyncHTTPClient()
 
-    if concurrency:
-        semaphore = Semaphore(concurrency)
+    semaphore = Semaphore(concurrency) if concurrency and limiter is None else None
+    if not workers:
+        workers = limiter.maximum if limiter is not None else concurrency or 100
 
-        @coroutine
-        def fetch(req):
-            """client.fetch wrapped in a semaphore to limit concurrency"""
-            yield semaphore.acquire()
-            try:
-                return (yield client.fetch(req))
-            finally:
-                yield semaphore.release()
+    async def fetch(req):
+        """client.fetch wrapped in a semaphore (or the limiter) to limit concurrency"""
+        queued = time.monotonic()
+        if limiter is not None:
+            await limiter.acquire()
+        elif semaphore is not None:
+            await semaphore.acquire()
+        HUB_REQUEST_QUEUE_DURATION.observe(time.monotonic() - queued)
+        code = 599
+        start = time.monotonic()
+        try:
+            resp = await client.fetch(req)
+            code = resp.code
+            return resp
+        except HTTPClientError as e:
+            code = e.code
+            raise
+        finally:
+            HUB_REQUEST_DURATION.labels(req.method, code).observe(time.monotonic() - start)
+            if limiter is not None:
+                limiter.release(start, code)
+            elif semaphore is not None:
+                semaphore.release()
 
-    else:
-        fetch = client.fetch
+    # earliest time at which each user may need to be culled
+    deadlines = {}
+
+    # with low free capacity, the missing resources, the idle servers
+    # that could be stopped to recover them, and the ones chosen
+    deficit = None
+    if pressure is not None and usernames is None:
+        deficit = await pressure.deficit()
+        if deficit:
+            app_log.warning(
+                "Low free capacity, missing %s",
+                ', '.join('%s=%g' % item for item in sorted(deficit.items())),
+            )
+    candidates = [] if deficit else None
+    reclaim = set()
+
+    def update_deadline(name, deadline):
+        if schedule is not None:
+            deadlines[name] = min(deadlines.get(name, deadline), deadline)
+
+    async def probe_server(name, server_name, server):
+        """Inactivity of a server according to the probes, None if they don't know"""
+        results = await asyncio.gather(
+            *[probe.probe(name, server_name, server, auth_header) for probe in probes],
+            return_exceptions=True,
+        )
+        activities = []
+        for probe, result in zip(probes, results):
+            if isinstance(result, Exception):
+                app_log.debug("Probe %s failed for %s: %s", probe.name, name, result)
+                PROBE_RESULTS.labels(probe.name, 'error').inc()
+                continue
+            record_probe(probe, result)
+            if result.busy:
+                return timedelta(0)
+            if result.last_activity is not None:
+                activities.append(result.last_activity)
+        if not activities:
+            return None
+        return max(timedelta(0), now - max(activities))
 
-    resp = yield fetch(req)
-    users = json.loads(resp.body.decode('utf8', 'replace'))
-    futures = []
+    def idle_deadline(inactive, age):
+        """When something inactive for and aged as given will have to be culled"""
+        deadline = now + timedelta(seconds=inactive_limit) - (inactive or timedelta(0))
+        if max_age and age is not None:
+            deadline = min(deadline, now + timedelta(seconds=max_age) - age)
+        return deadline
 
-    @coroutine
-    def handle_server(user, server_name, server, max_age, inactive_limit):
+    async def handle_server(user, server_name, server, max_age, inactive_limit):
         """Handle (maybe) culling a single server
 
         "server" is the entire server model from the API.
@@ -137,6 +296,7 @@ def cull_idle(
         Returns True if server is now stopped (user removable),
         False otherwise.
         """
+        SERVERS_EVALUATED.inc()
         log_name = user['name']
         if server_name:
             log_name = '%s/%s' % (user['name'], server_name)
@@ -144,6 +304,8 @@ def cull_idle(
             app_log.warning(
                 "Not culling server %s with pending %s", log_name, server['pending']
             )
+            CULL_OUTCOMES.labels('pending').inc()
+            update_deadline(user['name'], now)
             return False
 
         # jupyterhub < 0.9 defined 'server.url' once the server was ready
@@ -157,6 +319,8 @@ def cull_idle(
             app_log.warning(
                 "Not culling not-ready not-pending server %s: %s", log_name, server
             )
+            CULL_OUTCOMES.labels('pending').inc()
+            update_deadline(user['name'], now)
             return False
 
         if server.get('started'):
@@ -176,6 +340,22 @@ def cull_idle(
             # for running servers
             inactive = age
 
+        if probes and not (pause is not None and pause.is_paused(user['name'], server_name)):
+            probed = await probe_server(user['name'], server_name, server)
+            if probed is not None:
+                inactive = probed
+
+        if activity is not None:
+            pushed = activity.get(user['name'], server_name)
+            # ignore the activity of a previous server with the same name
+            if pushed is not None and (age is None or pushed >= now - age):
+                inactive = min(inactive, now - pushed) if inactive is not None else now - pushed
+
+        if pause is not None:
+            resumed = pause.last_resume(user['name'], server_name)
+            if resumed is not None:
+                inactive = min(inactive, now - resumed) if inactive is not None else now - resumed
+
         # CUSTOM CULLING TEST CODE HERE
         # Add in additional server tests here.  Return False to mean "don't
         # cull", True means "cull immediately", or, for example, update some
@@ -195,7 +375,7 @@ def cull_idle(
         )
         if should_cull:
             app_log.info(
-                "Culling server %s (inactive for %s)", log_name, format_td(inactive)
+                "Culling server %s (inactive for %s)", log_name, LazyTd(inactive)
             )
 
         if max_age and not should_cull:
@@ -206,20 +386,67 @@ def cull_idle(
                 app_log.info(
                     "Culling server %s (age: %s, inactive for %s)",
                     log_name,
-                    format_td(age),
-                    format_td(inactive),
+                    LazyTd(age),
+                    LazyTd(inactive),
                 )
                 should_cull = True
 
+        outcome = 'culled'
+        idle_enough = (
+            pressure is not None
+            and inactive is not None
+            and inactive.total_seconds() >= pressure.min_idle
+        )
+        if not should_cull and idle_enough and (user['name'], server_name) in reclaim:
+            app_log.info(
+                "Culling server %s to reclaim its resources (inactive for %s)",
+                log_name,
+                LazyTd(inactive),
+            )
+            should_cull = True
+            outcome = 'reclaimed'
+
         if not should_cull:
             app_log.debug(
                 "Not culling server %s (age: %s, inactive for %s)",
                 log_name,
-                format_td(age),
-                format_td(inactive),
+                LazyTd(age),
+                LazyTd(inactive),
             )
+            if candidates is not None and idle_enough:
+                resources = server_resources(server)
+                candidates.append(
+                    (
+                        pressure.score(resources, inactive.total_seconds()),
+                        user['name'],
+                        server_name,
+                        resources,
+                    )
+                )
+            deadline = idle_deadline(inactive, age)
+            if pause is not None and inactive is not None:
+                paused = pause.is_paused(user['name'], server_name)
+                if paused and inactive.total_seconds() < pause.after:
+                    app_log.info(
+                        "Resuming server %s (inactive for %s)", log_name, LazyTd(inactive)
+                    )
+                    await pause.resume(user['name'], server_name)
+                elif not paused and inactive.total_seconds() >= pause.after:
+                    app_log.info(
+                        "Pausing server %s (inactive for %s)", log_name, LazyTd(inactive)
+                    )
+                    await pause.pause(user['name'], server_name, server)
+                elif not paused:
+                    deadline = min(
+                        deadline, now + timedelta(seconds=pause.after) - inactive
+                    )
+            update_deadline(user['name'], deadline)
             return False
 
+        if pause is not None and pause.is_paused(user['name'], server_name):
+            # let the server shut down cleanly
+            await pause.resume(user['name'], server_name)
+
         if server_name:
             # culling a named server
             delete_url = url + "/users/%s/servers/%s" % (
@@ -230,21 +457,37 @@ def cull_idle(
             delete_url = url + '/users/%s/server' % quote(user['name'])
 
         req = HTTPRequest(url=delete_url, method='DELETE', headers=auth_header)
-        resp = yield fetch(req)
+        resp = await fetch(req)
+        if activity is not None:
+            activity.forget(user['name'], server_name)
+        if pause is not None:
+            pause.forget(user['name'], server_name)
+        for probe in probes or []:
+            if hasattr(probe, 'forget'):
+                probe.forget(user['name'], server_name)
+        if candidates is not None:
+            # frees the resources counted in the deficit
+            release(deficit, server_resources(server))
         if resp.code == 202:
             app_log.warning("Server %s is slow to stop", log_name)
+            CULL_OUTCOMES.labels('slow_stop').inc()
+            if slow_stops is not None and user['name'] not in slow_stops:
+                slow_stops.add(user['name'])
+                IOLoop.current().spawn_callback(follow_slow_stop, user['name'])
+            update_deadline(user['name'], now)
             # return False to prevent culling user with pending shutdowns
             return False
+        CULL_OUTCOMES.labels(outcome).inc()
         return True
 
-    @coroutine
-    def handle_user(user):
+    async def handle_user(user):
         """Handle one user.
 
         Create a list of their servers, and async exec them.  Wait for
         that to be done, and if all servers are stopped, possibly cull
         the user.
         """
+        USERS_EVALUATED.inc()
         # shutdown servers first.
         # Hub doesn't allow deleting users with running servers.
         # jupyterhub 0.9 always provides a 'servers' model.
@@ -267,7 +510,7 @@ def cull_idle(
             handle_server(user, server_name, server, max_age, inactive_limit)
             for server_name, server in servers.items()
         ]
-        results = yield multi(server_futures)
+        results = await asyncio.gather(*server_futures)
 
         # some servers are still running, cannot cull users
         still_alive = len(results) - sum(results)
@@ -302,6 +545,11 @@ def cull_idle(
             # which introduces the 'created' field which is never None
             inactive = age
 
+        if activity is not None:
+            pushed = activity.latest(user['name'])
+            if pushed is not None:
+                inactive = min(inactive, now - pushed) if inactive is not None else now - pushed
+
         should_cull = (
             inactive is not None and inactive.total_seconds() >= inactive_limit
         )
@@ -316,8 +564,8 @@ def cull_idle(
                 app_log.info(
                     "Culling user %s (age: %s, inactive for %s)",
                     user['name'],
-                    format_td(age),
-                    format_td(inactive),
+                    LazyTd(age),
+                    LazyTd(inactive),
                 )
                 should_cull = True
 
@@ -325,34 +573,248 @@ def cull_idle(
             app_log.debug(
                 "Not culling user %s (created: %s, last active: %s)",
                 user['name'],
-                format_td(age),
-                format_td(inactive),
+                LazyTd(age),
+                LazyTd(inactive),
             )
+            update_deadline(user['name'], idle_deadline(inactive, age))
             return False
 
         req = HTTPRequest(
             url=url + '/users/%s' % user['name'], method='DELETE', headers=auth_header
         )
-        yield fetch(req)
+        await fetch(req)
+        CULL_OUTCOMES.labels('user_culled').inc()
         return True
 
-    for user in users:
-        futures.append((user['name'], handle_user(user)))
+    async def handle_users(users, by_name=False, check_tickets=True):
+        """Handle a list of users and run the ticket hooks
+
+        The users are handled by a fixed number of workers, and the result
+        of each user (ticket hooks, scheduling) is handled as soon as it is
+        ready. If by_name, users is a list of names whose models are
+        requested by the workers. If not check_tickets, the tickets of the
+        users still running are not checked (already done in this cycle).
+
+        Returns the names of the users that still have servers running.
+        """
+        alive = []
+        queue = asyncio.Queue(maxsize=workers)
+
+        async def handle(item):
+            name = item if by_name else item['name']
+            if slow_stops and name in slow_stops:
+                # being handled by follow_slow_stop
+                alive.append(name)
+                return
+            try:
+                user = await fetch_user(name) if by_name else item
+                if user is None:
+                    return
+                result = await handle_user(user)
+            except Exception:
+                CULL_OUTCOMES.labels('error').inc()
+                app_log.exception("Error processing %s", name)
+                result = None
+            if result:
+                app_log.debug("Finished culling %s", name)
+                if hooks: hooks.delete(name)
+                if active_users is not None and usernames is not None:
+                    # already handled, not to be found stopped by the next full scan
+                    active_users.discard(name)
+                return
+            alive.append(name)
+            if slow_stops and name in slow_stops:
+                return
+            if result is not None and hooks and check_tickets:
+                hooks.check(name)
+            if schedule is not None:
+                schedule(name, deadlines.pop(name, None))
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                try:
+                    await handle(item)
+                except Exception:
+                    # e.g. the state store, outside of the checks of the user:
+                    # keep the worker going, or the queue fills up and the cycle never ends
+                    CULL_OUTCOMES.labels('error').inc()
+                    app_log.exception("Error handling %s", item if by_name else item['name'])
+
+        tasks = [asyncio.ensure_future(worker()) for i in range(min(workers, len(users)))]
+        for item in users:
+            await queue.put(item)
+        for task in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+        if hooks:
+            await hooks.flush()
+        return alive
 
-    for (name, f) in futures:
+    async def fetch_user(name):
+        """Get a single user model, None if the user no longer exists"""
+        req = HTTPRequest(url=url + '/users/%s' % quote(name), headers=auth_header)
         try:
-            result = yield f
+            resp = await fetch(req)
+        except HTTPClientError as e:
+            if e.code != 404:
+                raise
+            app_log.debug("User %s no longer exists", name)
+            return None
+        return json.loads(resp.body.decode('utf8', 'replace'))
+
+    async def follow_slow_stop(name):
+        """Wait for the servers of a user to stop, then finish handling the user"""
+        nonlocal now
+        delay = 1
+        deadline = time.monotonic() + slow_stop_timeout
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                user = await fetch_user(name)
+                if user is None:
+                    # deleted in the meantime
+                    break
+                stopping = [
+                    server
+                    for server in user.get('servers', {}).values()
+                    if server.get('pending') == 'stop'
+                ]
+                if not stopping and user.get('pending') != 'stop':
+                    break
+                if time.monotonic() + delay > deadline:
+                    app_log.warning(
+                        "Servers of %s still stopping after %i seconds", name, slow_stop_timeout
+                    )
+                    if schedule is not None:
+                        schedule(name, None)
+                    return
+                delay = min(2 * delay, 30)
         except Exception:
-            app_log.exception("Error processing %s", name)
+            app_log.exception("Error waiting for the servers of %s to stop", name)
+            if schedule is not None:
+                schedule(name, None)
+            return
+        finally:
+            slow_stops.discard(name)
+
+        app_log.info("Servers of %s stopped", name)
+        if not simulated:
+            # the stop took up to slow_stop_timeout since the cycle started:
+            # measure the inactivity and the next deadline from now
+            now = datetime.now(timezone.utc)
+        if user is None:
+            if hooks:
+                hooks.delete(name)
+                await hooks.flush()
         else:
-            if result:
-                app_log.debug("Finished culling %s", name)
-                if not disable_hooks: delete_ticket(name)
+            await handle_users([user])
+
+    async def handle_active_users():
+        """Handle the users with active servers, page by page"""
+        # Request only the users with running or pending servers, one page at a time.
+        # Each page is parsed and handled before requesting the next one,
+        # so that we never hold the full list of users in memory.
+        headers = dict(auth_header, Accept='application/jupyterhub-pagination+json')
+        # our users with servers still running, and all the users listed
+        seen = set()
+        listed = set()
+        offset = 0
+        while True:
+            params = urlencode({'state': 'active', 'offset': offset, 'limit': page_size})
+            req = HTTPRequest(url=url + '/users?' + params, headers=headers)
+            resp = await fetch(req)
+            page = json.loads(resp.body.decode('utf8', 'replace'))
+            if isinstance(page, dict):
+                users = page['items']
+                next_page = page['_pagination'].get('next')
             else:
-                if not disable_hooks: check_ticket(name)
+                # jupyterhub without pagination metadata returns a plain list
+                users = page
+                next_page = len(users) >= page_size or None
+            del page
+
+            listed.update(user['name'] for user in users)
+            mine = owned(users)
+            alive = await handle_users(mine)
+            seen.update(alive)
+            if not next_page or not users:
+                break
+            # Users whose servers we stopped are no longer active, so the
+            # following users moved up in the list
+            offset += len(users) - (len(mine) - len(alive))
+
+        if active_users is not None:
+            # Missing from the listing doesn't mean stopped: servers stopped by
+            # someone else during the scan shift the offsets, and skip users.
+            # Check every missing user, and handle the ones still active,
+            # a page at a time (e.g. all the users, after a restart of the Hub).
+            missing = sorted(active_users - listed)
+            for i in range(0, len(missing), page_size):
+                chunk = missing[i : i + page_size]
+                users = await asyncio.gather(*(fetch_user(name) for name in chunk))
+                skipped = [user for user in users if user is not None and user.get('servers')]
+                del users
+                seen.update(await handle_users(skipped))
+                if hooks:
+                    # Servers stopped outside of the culler (e.g. by the user)
+                    for name in set(chunk) - {user['name'] for user in skipped}:
+                        hooks.delete(name)
+            if hooks:
+                await hooks.flush()
+            active_users.difference_update(active_users - seen)
+            active_users.update(seen)
+
+    def owned(users):
+        if owns is None:
+            return users
+        return [user for user in users if owns(user['name'])]
+
+    start = time.monotonic()
+    if usernames is not None:
+        if owns is not None:
+            usernames = [name for name in usernames if owns(name)]
+        await handle_users(usernames, by_name=True)
+    elif paginate:
+        await handle_active_users()
+    else:
+        req = HTTPRequest(url=url + '/users', headers=auth_header)
+        resp = await fetch(req)
+        users = json.loads(resp.body.decode('utf8', 'replace'))
+        await handle_users(owned(users))
+        del users
+
+    if pressure is not None and usernames is None:
+        # plan updates the deficit with the resources released
+        scanned = dict(deficit)
+    if candidates:
+        # stop the biggest idle servers, no matter their timeout
+        reclaim.update(pressure.plan(candidates, deficit))
+        candidates = None
+        names = sorted({name for name, server_name in reclaim})
+        # their tickets were checked by the pass that found them idle
+        alive = await handle_users(names, by_name=True, check_tickets=False)
+        if active_users is not None:
+            active_users.difference_update(set(names) - set(alive))
+    if deficit and any(value > 0 for value in deficit.values()):
+        app_log.warning("Not enough idle servers to recover the free capacity")
+    if pressure is not None and usernames is None:
+        pressure.scanned(scanned, len(reclaim))
+    if activity is not None and usernames is None:
+        activity.prune(now - timedelta(seconds=inactive_limit))
+    CYCLE_DURATION.labels('due' if usernames is not None else 'full').observe(
+        time.monotonic() - start
+    )
 
 
 def main():
+    if sys.argv[1:2] == ['simulate']:
+        from .simulate import main as simulate_main
+
+        return simulate_main(sys.argv[2:])
+
     define(
         'url',
         default=os.environ.get('JUPYTERHUB_API_URL'),
@@ -384,14 +846,223 @@ def main():
                 so limit the number of API requests we have outstanding at any given time.
                 """,
     )
+    define(
+        'adaptive_concurrency',
+        default=False,
+        help="""Adapt the limit of concurrent requests to the Hub to its latency and errors.
+
+                Starts from concurrency, increases the limit while the Hub answers fast and
+                decreases it on errors (5xx, 429), slow stops (202) or slow answers.
+                """,
+    )
+    define(
+        'keepalive_connections',
+        default=0,
+        help="""Send the requests to the Hub over a pool of this many keep-alive connections
+                (0 to use the tornado HTTP client, which opens a connection per request without pycurl)""",
+    )
+    define(
+        'workers',
+        default=0,
+        help="Number of users handled at the same time (0 for the maximum concurrency of the requests)",
+    )
+    define('concurrency_min', default=1, help="Minimum limit of concurrent requests with adaptive concurrency")
+    define('concurrency_max', default=100, help="Maximum limit of concurrent requests with adaptive concurrency")
+    define(
+        'latency_target',
+        default=1.0,
+        help="Latency (in seconds) of the Hub above which adaptive concurrency decreases the limit",
+    )
+    define(
+        'paginate',
+        default=False,
+        help="""Request the users page by page, only for those with active servers.
+
+                Requires jupyterhub >= 2.0. Keeps the memory usage and the load on the Hub
+                bounded when there are a lot of users.
+                """,
+    )
+    define(
+        'slow_stop_timeout',
+        default=300,
+        help="""How long (in seconds) to wait for servers that are slow to stop, to finish
+                culling their users right after they stop (0 to wait for the next cycle)""",
+    )
+    define(
+        'pause_after',
+        default=0,
+        help="""Pause the servers inactive for this long (in seconds), before culling them after timeout.
+                Paused servers are resumed when they are active again (0 to disable)""",
+    )
+    define(
+        'pause_backend',
+        default='docker',
+        help="How to pause the servers: docker, cgroup, local (only keeps track, for testing) or python:<module.Class>",
+    )
+    define('pause_docker_command', default='docker', help="Command to run docker pause and docker unpause")
+    define(
+        'pause_container_template',
+        default='jupyter-{username}',
+        help="Name of the container of a server, when its spawner state has no container_id",
+    )
+    define(
+        'pause_cgroup_template',
+        default='',
+        help="cgroup directory of a server for the cgroup backend, formatted with username, servername and container_id",
+    )
+    define(
+        'probes',
+        default='',
+        help="""Comma-separated probes of the activity of the servers, that take precedence over
+                the Hub last_activity: kernels (kernels and terminals of the server) and cgroup_cpu
+                (CPU usage of the container)""",
+    )
+    define(
+        'probe_server_url',
+        default='',
+        help="URL where the kernels probe reaches the servers, e.g. the proxy http://localhost:8000",
+    )
+    define(
+        'probe_cgroup_template',
+        default='',
+        help="cgroup directory of a server for the cgroup_cpu probe, formatted with username, servername and container_id",
+    )
+    define(
+        'probe_cpu_threshold',
+        default=0.05,
+        help="CPU usage (in cores) above which the cgroup_cpu probe considers a server busy",
+    )
+    define(
+        'probe_concurrency',
+        default=10,
+        help="Maximum number of requests of the kernels probe to the servers at the same time",
+    )
+    define(
+        'pressure_capacity_source',
+        default='',
+        help="""Where to read the free capacity, to reclaim the biggest idle servers when it's low:
+                file:<path> (a JSON file like {"cores": 12, "memory": 40, "gpus": 0}),
+                static:<resources> or python:<module.Class> (default '', disabled)""",
+    )
+    define(
+        'pressure_thresholds',
+        default='cores=0,memory=0,gpus=0',
+        help="Minimum free resources (cores, memory in GB, gpus) below which idle servers are reclaimed",
+    )
+    define(
+        'pressure_min_idle',
+        default=300,
+        help="Minimum inactivity (in seconds) of the servers reclaimed when the free capacity is low",
+    )
+    define(
+        'pressure_check_every',
+        default=60,
+        help="The interval (in seconds) for checking the free capacity",
+    )
+    define(
+        'shard_lease_dir',
+        default='',
+        help="""Directory shared by several culler replicas, to split the users among them.
+
+                Every replica culls only the users that a consistent hash of the live replicas
+                (the ones with a valid lease file in this directory) assigns to it.
+                """,
+    )
+    define('replica_id', default=socket.gethostname(), help="Name of this culler replica, when sharding")
+    define('lease_ttl', default=60, help="Validity (in seconds) of the lease of a culler replica, when sharding")
+    define('page_size', default=200, help="Number of users requested per page when paginating")
+    define(
+        'scheduler',
+        default='periodic',
+        help="""How to schedule the culling: 'periodic' checks all the users every cull_every seconds,
+                'deadline' checks each user only when its servers are due to be culled,
+                retrying every cull_every seconds the ones that could not be culled yet.
+                """,
+    )
+    define(
+        'resync_every',
+        default=0,
+        help="The interval (in seconds) for checking all the users with the deadline scheduler (default: timeout)",
+    )
+    define(
+        'port',
+        default=0,
+        help="Port where the culler exposes its Prometheus metrics on /metrics (0 to disable)",
+    )
+    define('ip', default='', help="IP address where the culler listens when a port is given")
+    define(
+        'activity_push',
+        default=False,
+        help="""Receive on the port the activity pushed by the servers, authenticated with their own
+                Hub API token (also enabled by SWANCULLER_ACTIVITY_TOKEN, for trusted sidecars)""",
+    )
     define('hooks_dir', default="/srv/jupyterhub/culler", help="Path to the directory for the krb tickets scripts (check_ticket.sh and delete_ticket.sh)")
     define('disable_hooks', default=False, help="The user's home is a temporary scratch directory and we should not check krb tickets")
+    define(
+        'state_file',
+        default='',
+        help="""Path to a SQLite database where the culler keeps its state across restarts.
+
+                When set, the expiry of the krb tickets is remembered and check_ticket.sh
+                only runs for the tickets about to expire.
+                """,
+    )
+    define(
+        'startup_spread',
+        default=60,
+        help="""With state_file, spread over this many seconds (after a restart) the checks that were
+                due while the culler was not running""",
+    )
+    define(
+        'ticket_renew_window',
+        default=3600,
+        help="Time (in seconds) before the expiry of a krb ticket when check_ticket.sh runs again (requires state_file)",
+    )
+    define(
+        'ticket_lifetime',
+        default=86400,
+        help="Assumed validity (in seconds) of a krb ticket after check_ticket.sh, if the script doesn't report it",
+    )
+    define('hooks_concurrency', default=4, help="Maximum number of krb tickets scripts running at the same time")
+    define(
+        'hooks_batch_size',
+        default=1,
+        help="""Maximum number of users given as arguments to each invocation of the krb tickets scripts.
+
+                Values greater than 1 require scripts that accept more than one username.
+                """,
+    )
 
 
     parse_command_line()
+    if options.scheduler not in ('periodic', 'deadline'):
+        raise OptionsError("Unknown scheduler %r, expected 'periodic' or 'deadline'" % options.scheduler)
     if not options.cull_every:
         options.cull_every = options.timeout // 2
+    if not options.resync_every:
+        options.resync_every = options.timeout
     api_token = os.environ['JUPYTERHUB_API_TOKEN']
+    activity_token = os.environ.get('SWANCULLER_ACTIVITY_TOKEN')
+    if options.activity_push and not (options.port and options.url):
+        raise OptionsError("activity_push needs a port to listen on, and the url of the Hub API to check the tokens")
+    activity = None
+    store = None
+    if options.state_file:
+        store = StateStore(options.state_file)
+    pause = None
+    if options.pause_after:
+        if options.pause_after >= options.timeout:
+            app_log.warning("pause_after is not shorter than timeout, servers will be culled before being paused")
+        pause = PauseTier(
+            load_pause_backend(
+                options.pause_backend,
+                docker_command=options.pause_docker_command,
+                container_template=options.pause_container_template,
+                cgroup_template=options.pause_cgroup_template,
+            ),
+            options.pause_after,
+            store=store,
+        )
 
     try:
         AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
@@ -403,23 +1074,159 @@ def main():
         )
 
     loop = IOLoop.current()
+    if options.port:
+        if prometheus_client is None:
+            app_log.warning("prometheus_client is not installed, metrics will not be available")
+        handlers = [(r'/metrics', MetricsHandler)]
+        token_owners = None
+        if options.activity_push or activity_token:
+            handlers.append((r'/users/([^/]+)/activity', ActivityHandler))
+            activity = ActivityIndex()
+            if pause is not None:
+                handlers.append((r'/users/([^/]+)/resume', ResumeHandler))
+            if options.url:
+                token_owners = TokenOwners(options.url)
+        web_app = Application(
+            handlers,
+            activity=activity,
+            activity_token=activity_token,
+            token_owners=token_owners,
+            pause=pause,
+        )
+        web_app.listen(options.port, options.ip)
+    elif options.activity_push or activity_token:
+        app_log.warning("The activity push is enabled but there is no port to receive the activity")
+
+    hooks = None
+    if not options.disable_hooks:
+        hooks = TicketHooks(
+            options.hooks_dir,
+            concurrency=options.hooks_concurrency,
+            batch_size=options.hooks_batch_size,
+            store=store,
+            renew_window=options.ticket_renew_window,
+            ticket_lifetime=options.ticket_lifetime,
+        )
+    coordinator = None
+    if options.shard_lease_dir:
+        coordinator = FileLeaseCoordinator(
+            options.shard_lease_dir, options.replica_id, ttl=options.lease_ttl
+        )
+        coordinator.start()
+
+    client = None
+    if options.keepalive_connections:
+        client = HubClient(max_connections=options.keepalive_connections)
+    limiter = None
+    if options.adaptive_concurrency:
+        limiter = AdaptiveLimiter(
+            options.concurrency,
+            minimum=options.concurrency_min,
+            maximum=options.concurrency_max,
+            latency_target=options.latency_target,
+        )
+    pressure = None
+    if options.pressure_capacity_source:
+        pressure = PressurePolicy(
+            load_capacity_source(options.pressure_capacity_source),
+            parse_resources(options.pressure_thresholds),
+            min_idle=options.pressure_min_idle,
+        )
+    active_users = set()
+    slow_stops = set() if options.slow_stop_timeout else None
+    # users whose servers were slow to stop when the culler stopped
+    stopping = []
+    if store is not None:
+        active_users = store.user_set('active_users')
+        if slow_stops is not None:
+            slow_stops = store.user_set('slow_stops')
+            stopping = sorted(slow_stops)
+            slow_stops.clear()
     cull = partial(
         cull_idle,
         url=options.url,
         api_token=api_token,
         inactive_limit=options.timeout,
         cull_users=options.cull_users,
-        disable_hooks=options.disable_hooks,
+        hooks=hooks,
         max_age=options.max_age,
         concurrency=options.concurrency,
+        limiter=limiter,
+        workers=options.workers,
+        paginate=options.paginate,
+        page_size=options.page_size,
+        active_users=active_users,
+        slow_stops=slow_stops,
+        slow_stop_timeout=options.slow_stop_timeout,
+        owns=coordinator.owns if coordinator else None,
+        client=client,
+        pressure=pressure,
+        activity=activity,
+        pause=pause,
+        probes=load_probes(
+            options.probes,
+            server_url=options.probe_server_url,
+            cgroup_template=options.probe_cgroup_template,
+            cpu_threshold=options.probe_cpu_threshold,
+            concurrency=options.probe_concurrency,
+        ),
     )
-    # schedule first cull immediately
-    # because PeriodicCallback doesn't start until the end of the first interval
-    loop.add_callback(cull)
-    # schedule periodic cull
-    pc = PeriodicCallback(cull, 1e3 * options.cull_every)
-    pc.start()
+    if options.scheduler == 'deadline':
+        scheduler = DeadlineScheduler(
+            cull,
+            resync_every=options.resync_every,
+            retry_every=options.cull_every,
+            store=store,
+            startup_spread=options.startup_spread,
+        )
+        scheduler.start()
+        full_cycle = scheduler.resync
+        if stopping:
+            loop.add_callback(cull, usernames=stopping, schedule=scheduler.schedule)
+    else:
+        lock = Lock()
+
+        async def full_cycle():
+            async with lock:
+                await cull()
+                if store is not None:
+                    store.set_meta('last_cycle', time.time())
+
+        def start_periodic():
+            # schedule first cull immediately
+            # because PeriodicCallback doesn't start until the end of the first interval
+            loop.add_callback(full_cycle)
+            # schedule periodic cull
+            pc = PeriodicCallback(full_cycle, 1e3 * options.cull_every)
+            pc.start()
+
+        delay = 0
+        last_cycle = store.get_meta('last_cycle') if store is not None else None
+        if last_cycle is not None:
+            # resume where the previous run left, or a bit later if it's overdue,
+            # so that restarts don't all hit the Hub at once
+            delay = last_cycle + options.cull_every - time.time()
+            if delay <= 0:
+                delay = random.uniform(0, options.startup_spread)
+            app_log.info("Resuming the culling in %i seconds", delay)
+        loop.call_later(delay, start_periodic)
+        if stopping:
+            loop.add_callback(cull, usernames=stopping)
+    if pressure is not None:
+
+        async def check_pressure():
+            # don't wait for the next cycle to reclaim resources,
+            # unless scanning again is unlikely to find anything
+            if pressure.should_scan(await pressure.deficit()):
+                await full_cycle()
+
+        PeriodicCallback(check_pressure, 1e3 * options.pressure_check_every).start()
     try:
         loop.start()
     except KeyboardInterrupt:
-        pass
\ No newline at end of file
+        pass
+    finally:
+        if coordinator:
+            coordinator.stop()
+        if client:
+            client.close()
\ No newline at end of file
@@ -0,0 +1,124 @@
+"""Local stand-in for the JupyterHub API, used to simulate and benchmark the culler
+
+Implements only the parts of the API used by the culler: listing users
+(with the state/offset/limit parameters of jupyterhub >= 2.0), getting
+and deleting a user, and stopping servers.
+"""
+import json
+from collections import Counter
+
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+
+class FakeHub(object):
+    """Serve the users models kept in memory
+
+    users is a dict of user models by name, as returned by the Hub API.
+    Stopped servers are removed from the models, see stop_server.
+    """
+
+    def __init__(self, users=None):
+        self.users = users if users is not None else {}
+        # number of requests received, by method
+        self.requests = Counter()
+        self._server = None
+
+    def list_users(self, state=None):
+        if state == 'active':
+            return [user for user in self.users.values() if user.get('servers')]
+        return list(self.users.values())
+
+    def stop_server(self, name, server_name):
+        """Stop a server, returns the status code of the response"""
+        self.users[name]['servers'].pop(server_name, None)
+        return 204
+
+    def delete_user(self, name):
+        self.users.pop(name, None)
+        return 204
+
+    def make_app(self):
+        settings = dict(hub=self)
+        return web.Application(
+            [
+                (r'/hub/api/users', _UsersHandler),
+                (r'/hub/api/users/([^/]+)', _UserHandler),
+                (r'/hub/api/users/([^/]+)/server', _ServerHandler),
+                (r'/hub/api/users/([^/]+)/servers/([^/]*)', _ServerHandler),
+            ],
+            **settings
+        )
+
+    def listen(self, port=0, address='127.0.0.1'):
+        """Start serving in the current IOLoop, returns the API URL"""
+        sockets = bind_sockets(port, address)
+        self._server = HTTPServer(self.make_app())
+        self._server.add_sockets(sockets)
+        port = sockets[0].getsockname()[1]
+        return 'http://%s:%i/hub/api' % (address, port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+
+class _BaseHandler(web.RequestHandler):
+    @property
+    def hub(self):
+        return self.settings['hub']
+
+    def prepare(self):
+        self.hub.requests[self.request.method] += 1
+
+    def write_json(self, model):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(model))
+
+
+class _UsersHandler(_BaseHandler):
+    def get(self):
+        users = self.hub.list_users(self.get_argument('state', None))
+        offset = int(self.get_argument('offset', 0))
+        limit = self.get_argument('limit', None)
+        limit = int(limit) if limit is not None else len(users)
+        page = users[offset : offset + limit]
+
+        if 'application/jupyterhub-pagination+json' not in self.request.headers.get('Accept', ''):
+            self.write_json(page)
+            return
+        next_page = None
+        if offset + limit < len(users):
+            next_page = {'offset': offset + limit, 'limit': limit}
+        self.write_json(
+            {
+                'items': page,
+                '_pagination': {
+                    'offset': offset,
+                    'limit': limit,
+                    'total': len(users),
+                    'next': next_page,
+                },
+            }
+        )
+
+
+class _UserHandler(_BaseHandler):
+    def get(self, name):
+        if name not in self.hub.users:
+            raise web.HTTPError(404)
+        self.write_json(self.hub.users[name])
+
+    def delete(self, name):
+        if name not in self.hub.users:
+            raise web.HTTPError(404)
+        self.set_status(self.hub.delete_user(name))
+
+
+class _ServerHandler(_BaseHandler):
+    def delete(self, name, server_name=''):
+        if name not in self.hub.users:
+            raise web.HTTPError(404)
+        self.set_status(self.hub.stop_server(name, server_name))
@@ -0,0 +1,136 @@
+"""Kerberos ticket hooks, run by the culler for every user
+
+check_ticket.sh renews the ticket of users with running servers,
+delete_ticket.sh removes the ticket of users whose servers are stopped.
+"""
+import asyncio
+import os
+import time
+from subprocess import DEVNULL, PIPE
+
+from tornado.log import app_log
+
+from .metrics import HOOK_DURATION
+
+CHECK_TICKET = 'check_ticket'
+DELETE_TICKET = 'delete_ticket'
+
+_messages = {
+    CHECK_TICKET: "Checking ticket for user(s) %s",
+    DELETE_TICKET: "Deleting ticket for user(s) %s",
+}
+
+
+class TicketHooks(object):
+    """Run the ticket scripts without blocking the culler
+
+    The scripts run as asyncio subprocesses, at most `concurrency` at a time.
+    With batch_size > 1 the usernames are grouped, and each invocation of a
+    script gets up to batch_size usernames as arguments, so the scripts need
+    to support receiving more than one user.
+
+    With a store (StateStore), the expiry of the tickets is remembered and
+    check_ticket.sh only runs once a ticket is within renew_window seconds
+    of expiring. check_ticket.sh can report the expiry of the tickets by
+    printing lines with "<username> <unix timestamp>", otherwise tickets are
+    assumed to be valid for ticket_lifetime seconds after each check.
+    """
+
+    def __init__(
+        self,
+        hooks_dir,
+        concurrency=4,
+        batch_size=1,
+        store=None,
+        renew_window=3600,
+        ticket_lifetime=86400,
+    ):
+        self.hooks_dir = hooks_dir
+        self.batch_size = max(1, batch_size)
+        self.store = store
+        self.renew_window = renew_window
+        self.ticket_lifetime = ticket_lifetime
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending = {CHECK_TICKET: [], DELETE_TICKET: []}
+        self._tasks = set()
+
+    def check(self, username):
+        """Renew the ticket of a user with running servers"""
+        if self.store is not None:
+            ticket = self.store.get_ticket(username)
+            if ticket and ticket[1] - time.time() > self.renew_window:
+                app_log.debug("Ticket for user %s is still fresh", username)
+                return
+        self._add(CHECK_TICKET, username)
+
+    def delete(self, username):
+        """Remove the ticket of a user without running servers"""
+        self._add(DELETE_TICKET, username)
+
+    def _add(self, hook, username):
+        pending = self._pending[hook]
+        pending.append(username)
+        if len(pending) >= self.batch_size:
+            self._start(hook)
+
+    def _start(self, hook):
+        usernames = self._pending[hook]
+        self._pending[hook] = []
+        task = asyncio.ensure_future(self._run(hook, usernames))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, hook, usernames):
+        """Run a script for some users, returns True if it succeeded"""
+        script = os.path.join(self.hooks_dir, '%s.sh' % hook)
+        stdout = PIPE if self.store is not None and hook == CHECK_TICKET else None
+        async with self._semaphore:
+            app_log.info(_messages[hook], ', '.join(usernames))
+            start = time.monotonic()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    'sudo', script, *usernames, stdin=DEVNULL, stdout=stdout
+                )
+                output, _ = await proc.communicate()
+            except OSError:
+                app_log.exception("Error running %s", script)
+                return False
+            finally:
+                HOOK_DURATION.labels(hook).observe(time.monotonic() - start)
+        if proc.returncode:
+            app_log.warning(
+                "%s failed for user(s) %s (exit code %s)",
+                script,
+                ', '.join(usernames),
+                proc.returncode,
+            )
+            return False
+
+        if self.store is not None:
+            if hook == CHECK_TICKET:
+                self._store_tickets(usernames, output)
+            else:
+                self.store.delete_tickets(usernames)
+        return True
+
+    def _store_tickets(self, usernames, output):
+        """Remember the expiry of the tickets just checked"""
+        now = time.time()
+        tickets = dict.fromkeys(usernames, now + self.ticket_lifetime)
+        for line in output.decode('utf8', 'replace').splitlines():
+            try:
+                username, expires = line.split()
+                expires = float(expires)
+            except ValueError:
+                continue
+            if username in tickets:
+                tickets[username] = expires
+        self.store.set_tickets(tickets, now)
+
+    async def flush(self):
+        """Run the incomplete batches and wait for all the scripts to finish"""
+        for hook, pending in self._pending.items():
+            if pending:
+                self._start(hook)
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
@@ -0,0 +1,178 @@
+"""HTTP client for the Hub API with a pool of persistent connections
+
+The tornado clients open a new connection (and TLS session) for every
+request, unless pycurl is available. For big sweeps over the users that
+setup dominates, so this client keeps a bounded pool of HTTP/1.1 keep-alive
+connections to the Hub and reuses them for all the requests.
+
+It takes and returns the same objects as tornado's AsyncHTTPClient.fetch,
+and raises HTTPClientError for responses other than 2xx, like tornado does.
+"""
+import asyncio
+import ssl
+import time
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from tornado.httpclient import HTTPClientError, HTTPRequest, HTTPResponse
+from tornado.httputil import HTTPHeaders
+from tornado.log import app_log
+
+
+class _Connection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+
+class HubClient(object):
+    """Send the requests over at most max_connections keep-alive connections"""
+
+    def __init__(self, max_connections=10, request_timeout=20, validate_cert=True):
+        self.max_connections = max_connections
+        self.request_timeout = request_timeout
+        self.validate_cert = validate_cert
+        self._semaphore = asyncio.Semaphore(max_connections)
+        # idle connections, by (scheme, host, port)
+        self._idle = {}
+
+    def _ssl_context(self):
+        context = ssl.create_default_context()
+        if not self.validate_cert:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=self._ssl_context() if scheme == 'https' else None
+        )
+        return _Connection(reader, writer)
+
+    async def fetch(self, request, raise_error=True):
+        if isinstance(request, str):
+            request = HTTPRequest(request)
+        start = time.monotonic()
+        parts = urlsplit(request.url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        async with self._semaphore:
+            idle = self._idle.setdefault(key, [])
+            try:
+                response = await asyncio.wait_for(
+                    self._send(key, idle, parts, request), self.request_timeout
+                )
+            except asyncio.TimeoutError:
+                response = HTTPResponse(request, 599, error=HTTPClientError(599, 'Timeout'))
+            except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                # connection errors are raised as they are, like tornado does
+                response = HTTPResponse(request, 599, error=e)
+        response.request_time = time.monotonic() - start
+        if raise_error and response.error:
+            raise response.error
+        return response
+
+    async def _send(self, key, idle, parts, request):
+        """Send the request over an idle connection, or a new one"""
+        while idle:
+            connection = idle.pop()
+            try:
+                return await self._request(connection, idle, parts, request)
+            except (OSError, asyncio.IncompleteReadError):
+                # the Hub closed the idle connection in the meantime
+                app_log.debug("Retrying %s %s on a new connection", request.method, request.url)
+                connection.close()
+            except BaseException:
+                connection.close()
+                raise
+        connection = await self._connect(key)
+        try:
+            return await self._request(connection, idle, parts, request)
+        except BaseException:
+            connection.close()
+            raise
+
+    async def _request(self, connection, idle, parts, request):
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        body = request.body or b''
+        headers = HTTPHeaders(request.headers)
+        headers.setdefault('Host', parts.netloc)
+        headers.setdefault('Connection', 'keep-alive')
+        headers.setdefault('Accept-Encoding', 'identity')
+        if body or request.method in ('POST', 'PUT', 'PATCH'):
+            headers['Content-Length'] = str(len(body))
+        lines = ['%s %s HTTP/1.1' % (request.method, path)]
+        lines.extend('%s: %s' % (name, value) for name, value in headers.get_all())
+        connection.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1') + body)
+        await connection.writer.drain()
+
+        reader = connection.reader
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b'', None)
+        version, code, reason = (status_line.decode('latin1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        code = int(code)
+        response_headers = HTTPHeaders()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            response_headers.parse_line(line.decode('latin1'))
+
+        keep_alive = (
+            version == 'HTTP/1.1'
+            and response_headers.get('Connection', '').lower() != 'close'
+        )
+        if request.method == 'HEAD' or code in (204, 304) or 100 <= code < 200:
+            response_body = b''
+        elif response_headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            response_body = await self._read_chunked(reader)
+        elif 'Content-Length' in response_headers:
+            response_body = await reader.readexactly(int(response_headers['Content-Length']))
+        else:
+            response_body = await reader.read()
+            keep_alive = False
+
+        if keep_alive:
+            idle.append(connection)
+        else:
+            connection.close()
+
+        error = None
+        if not 200 <= code < 300:
+            error = HTTPClientError(code, reason, None)
+        response = HTTPResponse(
+            request,
+            code,
+            headers=response_headers,
+            buffer=BytesIO(response_body),
+            effective_url=request.url,
+            error=error,
+            reason=reason,
+        )
+        if error is not None:
+            error.response = response
+        return response
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0], 16)
+            if size == 0:
+                # trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    def close(self):
+        for idle in self._idle.values():
+            for connection in idle:
+                connection.close()
+        self._idle = {}
@@ -0,0 +1,55 @@
+"""Adaptive limit for the concurrent requests made to the Hub"""
+import time
+
+from tornado.locks import Condition
+from tornado.log import app_log
+
+from .metrics import HUB_CONCURRENCY_LIMIT
+
+
+class AdaptiveLimiter(object):
+    """Adjust the number of requests in flight with additive-increase/multiplicative-decrease
+
+    Every successful response faster than latency_target raises the limit by
+    1/limit (i.e. by one after a full window of requests), while a response
+    that shows the Hub is struggling (5xx, 429, a 202 "slow to stop", or a
+    latency above latency_target) multiplies it by backoff. Only requests
+    started after the last decrease can decrease the limit again, so that a
+    single burst of slow responses counts once.
+    The limit always stays between minimum and maximum.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=100, latency_target=1.0, backoff=0.5):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._condition = Condition()
+        HUB_CONCURRENCY_LIMIT.set(self.limit)
+
+    async def acquire(self):
+        """Wait for a free slot, returns the start time to give to release"""
+        while self._in_flight >= int(self.limit):
+            await self._condition.wait()
+        self._in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, code):
+        """Free the slot of a request, adapting the limit to its response code"""
+        self._in_flight -= 1
+        latency = time.monotonic() - started
+        congested = code in (202, 429) or code >= 500 or latency > self.latency_target
+        if congested:
+            if started > self._last_decrease:
+                self._last_decrease = time.monotonic()
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                app_log.debug(
+                    "Decreasing the Hub concurrency to %i (code %s, %.2fs)", self.limit, code, latency
+                )
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        HUB_CONCURRENCY_LIMIT.set(self.limit)
+        self._condition.notify(max(0, int(self.limit) - self._in_flight))
@@ -0,0 +1,110 @@
+"""Prometheus metrics of the culler
+
+prometheus_client is optional: if it's not installed the metrics
+are not collected and the /metrics endpoint is not available.
+"""
+from tornado import web
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+class _NoMetric(object):
+    """Stand-in for the metrics when prometheus_client is not installed"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    def set(self, value):
+        pass
+
+
+def _metric(kind, name, documentation, labelnames=()):
+    if prometheus_client is None:
+        return _NoMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames)
+
+
+CYCLE_DURATION = _metric(
+    'Histogram',
+    'swanculler_cycle_duration_seconds',
+    'Time taken by a culling cycle',
+    ['scan'],
+)
+
+USERS_EVALUATED = _metric(
+    'Counter', 'swanculler_users_evaluated', 'Number of users evaluated for culling'
+)
+
+SERVERS_EVALUATED = _metric(
+    'Counter', 'swanculler_servers_evaluated', 'Number of servers evaluated for culling'
+)
+
+CULL_OUTCOMES = _metric(
+    'Counter',
+    'swanculler_cull_outcomes',
+    'Result of culling servers and users (culled, reclaimed, user_culled, slow_stop, pending, paused, resumed, error)',
+    ['outcome'],
+)
+
+HUB_REQUEST_DURATION = _metric(
+    'Histogram',
+    'swanculler_hub_request_duration_seconds',
+    'Time taken by the requests to the Hub API',
+    ['method', 'code'],
+)
+
+HUB_REQUEST_QUEUE_DURATION = _metric(
+    'Histogram',
+    'swanculler_hub_request_queue_seconds',
+    'Time waiting for the concurrency limit before the requests to the Hub API',
+)
+
+HUB_CONCURRENCY_LIMIT = _metric(
+    'Gauge',
+    'swanculler_hub_concurrency_limit',
+    'Current limit of concurrent requests to the Hub API, with adaptive concurrency',
+)
+
+ACTIVITY_PUSHES = _metric(
+    'Counter', 'swanculler_activity_pushes', 'Number of activity updates pushed by the servers'
+)
+
+PROBE_REQUEST_DURATION = _metric(
+    'Histogram',
+    'swanculler_probe_request_duration_seconds',
+    'Time taken by the requests of the probes to the servers',
+    ['probe', 'code'],
+)
+
+PROBE_RESULTS = _metric(
+    'Counter',
+    'swanculler_probe_results',
+    'Results of the activity probes of the servers (busy, idle, unknown, error)',
+    ['probe', 'result'],
+)
+
+HOOK_DURATION = _metric(
+    'Histogram',
+    'swanculler_hook_duration_seconds',
+    'Time taken by the krb tickets scripts',
+    ['hook'],
+)
+
+
+class MetricsHandler(web.RequestHandler):
+    """Expose the metrics to Prometheus"""
+
+    def get(self):
+        if prometheus_client is None:
+            raise web.HTTPError(404, "prometheus_client is not installed")
+        self.set_header('Content-Type', prometheus_client.CONTENT_TYPE_LATEST)
+        self.write(prometheus_client.generate_latest())
@@ -0,0 +1,200 @@
+"""Pause idle servers before culling them
+
+After pause_after seconds of inactivity the container of a server is frozen,
+so its CPU is reclaimed while the kernels keep their state. It is resumed as
+soon as there is activity again (or the Hub asks for it, when the proxy can't
+reach the server), and only culled after the normal, longer, timeout.
+
+The backends freeze the containers with docker pause, with the cgroup freezer,
+or only pretend to (LocalPauseBackend, to test and simulate).
+"""
+import asyncio
+import importlib
+import os
+import shlex
+from datetime import datetime, timezone
+from subprocess import DEVNULL, PIPE
+
+from tornado.log import app_log
+
+from .metrics import CULL_OUTCOMES
+
+
+class PauseError(Exception):
+    pass
+
+
+def _target(template, name, server_name, server):
+    state = server.get('state') or {}
+    return template.format(
+        username=name,
+        servername=server_name,
+        container_id=state.get('container_id') or '',
+    )
+
+
+class DockerPauseBackend(object):
+    """Freeze the containers with docker pause
+
+    The container is the container_id of the spawner state (DockerSpawner),
+    or else container_template, formatted with username and servername.
+    """
+
+    def __init__(self, command='docker', container_template='jupyter-{username}'):
+        self.command = shlex.split(command)
+        self.container_template = container_template
+
+    def target(self, name, server_name, server):
+        state = server.get('state') or {}
+        return state.get('container_id') or _target(
+            self.container_template, name, server_name, server
+        )
+
+    async def _run(self, action, container):
+        proc = await asyncio.create_subprocess_exec(
+            *self.command, action, container, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE
+        )
+        stderr = (await proc.communicate())[1]
+        if proc.returncode:
+            raise PauseError(
+                "docker %s %s failed: %s" % (action, container, stderr.decode('utf8', 'replace').strip())
+            )
+
+    async def pause(self, target):
+        await self._run('pause', target)
+
+    async def resume(self, target):
+        await self._run('unpause', target)
+
+
+class CgroupFreezerBackend(object):
+    """Freeze the cgroup of the containers
+
+    cgroup_template is the cgroup directory, formatted with username,
+    servername and container_id, e.g.
+    /sys/fs/cgroup/system.slice/docker-{container_id}.scope
+    Supports cgroup v2 (cgroup.freeze) and v1 (freezer.state).
+    """
+
+    def __init__(self, cgroup_template):
+        self.cgroup_template = cgroup_template
+
+    def target(self, name, server_name, server):
+        return _target(self.cgroup_template, name, server_name, server)
+
+    def _freeze(self, cgroup, frozen):
+        v2 = os.path.join(cgroup, 'cgroup.freeze')
+        try:
+            if os.path.exists(v2):
+                with open(v2, 'w') as f:
+                    f.write('1' if frozen else '0')
+            else:
+                with open(os.path.join(cgroup, 'freezer.state'), 'w') as f:
+                    f.write('FROZEN' if frozen else 'THAWED')
+        except OSError as e:
+            raise PauseError("Cannot freeze cgroup %s: %s" % (cgroup, e))
+
+    async def pause(self, target):
+        self._freeze(target, True)
+
+    async def resume(self, target):
+        self._freeze(target, False)
+
+
+class LocalPauseBackend(object):
+    """Only keep track of the paused servers, to test and simulate"""
+
+    def __init__(self):
+        self.paused = set()
+
+    def target(self, name, server_name, server):
+        return '%s/%s' % (name, server_name)
+
+    async def pause(self, target):
+        self.paused.add(target)
+
+    async def resume(self, target):
+        self.paused.discard(target)
+
+
+def load_pause_backend(name, docker_command='docker', container_template='jupyter-{username}', cgroup_template=''):
+    """Create the backend docker, cgroup, local or python:<module.Class>"""
+    if name == 'docker':
+        return DockerPauseBackend(docker_command, container_template)
+    if name == 'cgroup':
+        return CgroupFreezerBackend(cgroup_template)
+    if name == 'local':
+        return LocalPauseBackend()
+    if name.startswith('python:'):
+        module, _, cls = name[len('python:'):].rpartition('.')
+        return getattr(importlib.import_module(module), cls)()
+    raise ValueError("Unknown pause backend: %s" % name)
+
+
+class PauseTier(object):
+    """Keep track of the servers paused with the backend
+
+    Servers are paused after pause_after seconds of inactivity. A resume
+    counts as activity, so a resumed server is not paused again until it's
+    idle for pause_after seconds.
+
+    With a store (StateStore), the paused servers are remembered across
+    restarts, so that they can still be resumed.
+    """
+
+    def __init__(self, backend, pause_after, store=None):
+        self.backend = backend
+        self.after = pause_after
+        self.store = store
+        # backend target of the paused servers, by (username, server name)
+        self.paused = store.get_paused() if store is not None else {}
+        # time of the last resume, by (username, server name)
+        self._resumed = {}
+
+    def is_paused(self, name, server_name):
+        return (name, server_name) in self.paused
+
+    def last_resume(self, name, server_name):
+        return self._resumed.get((name, server_name))
+
+    async def pause(self, name, server_name, server):
+        target = self.backend.target(name, server_name, server)
+        try:
+            await self.backend.pause(target)
+        except PauseError as e:
+            app_log.error("Error pausing %s: %s", name, e)
+            return False
+        self.paused[(name, server_name)] = target
+        self._resumed.pop((name, server_name), None)
+        if self.store is not None:
+            self.store.set_paused(name, server_name, target)
+        CULL_OUTCOMES.labels('paused').inc()
+        return True
+
+    async def resume(self, name, server_name):
+        """Resume a paused server, returns whether it was paused"""
+        target = self.paused.pop((name, server_name), None)
+        if target is None:
+            return False
+        if self.store is not None:
+            self.store.set_paused(name, server_name, None)
+        self._resumed[(name, server_name)] = datetime.now(timezone.utc)
+        try:
+            await self.backend.resume(target)
+        except PauseError as e:
+            app_log.error("Error resuming %s: %s", name, e)
+            # maybe stopped in the meantime, there's nothing else to do
+        CULL_OUTCOMES.labels('resumed').inc()
+        return True
+
+    async def resume_user(self, name):
+        """Resume all the paused servers of a user, returns their names"""
+        server_names = [s for n, s in self.paused if n == name]
+        await asyncio.gather(*(self.resume(name, server_name) for server_name in server_names))
+        return server_names
+
+    def forget(self, name, server_name):
+        """The server is stopped"""
+        if self.paused.pop((name, server_name), None) is not None and self.store is not None:
+            self.store.set_paused(name, server_name, None)
+        self._resumed.pop((name, server_name), None)
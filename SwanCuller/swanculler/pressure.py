@@ -0,0 +1,193 @@
+"""Reclaim the most expensive idle servers when the free capacity is low
+
+The free capacity (cores, memory in GB, gpus) comes from a capacity source:
+any object with an async free() method returning the free resources, e.g.
+{'cores': 12, 'memory': 40, 'gpus': 0}. When one of them is below its
+threshold, the idle servers are ordered by footprint x idle time, and the
+culler stops them from the top until the free capacity is back above the
+thresholds, even before the normal timeout.
+
+The resources of a server come from the spawner state (SwanSpawner stores
+ncores, memory and gpu there), or from the user options.
+"""
+import importlib
+import json
+import re
+
+from tornado.log import app_log
+
+# weight of each resource in the footprint of a server, in cores:
+# 4GB of memory count as one core, a gpu as 8 cores
+WEIGHTS = {'cores': 1, 'memory': 0.25, 'gpus': 8}
+
+# relative increase of a missing resource taken as a growing deficit,
+# so that the noise of the free memory doesn't count
+GROWTH = 0.05
+
+
+def parse_resources(value):
+    """Parse resources like cores=16,memory=64,gpus=1"""
+    resources = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        key, _, number = item.partition('=')
+        key = key.strip()
+        if key not in WEIGHTS:
+            raise ValueError("Unknown resource: %s" % key)
+        resources[key] = float(number)
+    return resources
+
+
+def _memory_gb(value):
+    """Memory in GB, from a number of GB or a string like '8G' or '512M'"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.match(r'^\s*([\d.]+)\s*([KMGT]?)i?B?\s*$', str(value), re.IGNORECASE)
+    if not match:
+        return 0
+    number, unit = match.groups()
+    return float(number) * {'K': 2 ** -20, 'M': 2 ** -10, 'G': 1, 'T': 2 ** 10, '': 2 ** -30}[
+        unit.upper()
+    ]
+
+
+def server_resources(server):
+    """Resources used by a server, from its spawner state or user options"""
+    state = server.get('state') or {}
+    options = server.get('user_options') or {}
+    cores = state.get('ncores') or options.get('ncores') or 1
+    memory = state.get('memory') or options.get('memory') or 0
+    if 'gpu' in state:
+        gpus = 1 if state['gpu'] else 0
+    else:
+        # SwanSpawner enables a gpu for the cuda releases
+        gpus = 1 if 'cu' in options.get('LCG-rel', '') else 0
+    return {'cores': float(cores), 'memory': _memory_gb(memory), 'gpus': gpus}
+
+
+def release(deficit, resources):
+    """Subtract the resources of a stopped server from the deficit"""
+    for key in deficit:
+        deficit[key] -= resources.get(key, 0)
+
+
+class FileCapacity(object):
+    """Free capacity read from a JSON file, written by an external monitor"""
+
+    def __init__(self, path):
+        self.path = path
+
+    async def free(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            app_log.exception("Error reading the free capacity from %s", self.path)
+            return {}
+
+
+class StaticCapacity(object):
+    """Fixed free capacity, to test and simulate the pressure mode"""
+
+    def __init__(self, free):
+        self._free = free
+
+    async def free(self):
+        return dict(self._free)
+
+
+def load_capacity_source(spec):
+    """Create the capacity source of file:<path>, static:<resources> or python:<module.Class>"""
+    kind, _, value = spec.partition(':')
+    if kind == 'file':
+        return FileCapacity(value)
+    if kind == 'static':
+        return StaticCapacity(parse_resources(value))
+    if kind == 'python':
+        module, _, name = value.rpartition('.')
+        return getattr(importlib.import_module(module), name)()
+    raise ValueError("Unknown capacity source: %s" % spec)
+
+
+class PressurePolicy(object):
+    """Decide which idle servers to stop when the free capacity is below thresholds
+
+    thresholds are the minimum free resources, e.g. {'cores': 16, 'gpus': 1}.
+    Only servers inactive for at least min_idle seconds are stopped.
+
+    While the deficit lasts, the checks of the free capacity only scan the
+    users again if the deficit grew or the last scan reclaimed servers;
+    otherwise they wait for 2 checks, then twice as many every time, up to
+    max_backoff checks.
+    """
+
+    def __init__(self, source, thresholds, min_idle=300, max_backoff=16):
+        self.source = source
+        self.thresholds = thresholds
+        self.min_idle = min_idle
+        self.max_backoff = max_backoff
+        # deficit seen by the last scan (None without pressure), and whether it reclaimed servers
+        self._scanned = None
+        self._reclaimed = False
+        # checks to skip before scanning again, and checks skipped so far
+        self._backoff = 2
+        self._skipped = 0
+
+    async def deficit(self):
+        """Resources missing to be above the thresholds, empty if there is no pressure"""
+        free = await self.source.free()
+        return {
+            key: threshold - float(free[key])
+            for key, threshold in self.thresholds.items()
+            if key in free and float(free[key]) < threshold
+        }
+
+    def scanned(self, deficit, reclaimed):
+        """Record the deficit found by a scan of all the users, and the number of servers it reclaimed"""
+        self._scanned = dict(deficit) if deficit else None
+        self._reclaimed = reclaimed > 0
+        self._skipped = 0
+        if reclaimed or not deficit:
+            self._backoff = 2
+
+    def should_scan(self, deficit):
+        """Whether a check that found this deficit should scan the users before the next cycle"""
+        if not deficit:
+            self._scanned = None
+            self._backoff = 2
+            return False
+        if (
+            self._scanned is None
+            or self._reclaimed
+            or any(value > self._scanned.get(key, 0) * (1 + GROWTH) for key, value in deficit.items())
+        ):
+            return True
+        self._skipped += 1
+        if self._skipped < self._backoff:
+            return False
+        app_log.info("The free capacity is still low, scanning again after %i checks", self._skipped)
+        self._backoff = min(2 * self._backoff, self.max_backoff)
+        return True
+
+    @staticmethod
+    def score(resources, inactive):
+        """Footprint x idle time of a server"""
+        return sum(WEIGHTS[key] * value for key, value in resources.items()) * inactive
+
+    def plan(self, candidates, deficit):
+        """Choose the servers to stop to cover the deficit
+
+        candidates are (score, username, server_name, resources) tuples,
+        deficit is updated with the resources freed by the chosen servers.
+        """
+        chosen = []
+        for score, name, server_name, resources in sorted(candidates, key=lambda c: c[0], reverse=True):
+            if not any(value > 0 for value in deficit.values()):
+                break
+            if not any(resources.get(key, 0) > 0 for key, value in deficit.items() if value > 0):
+                # doesn't help with the missing resources
+                continue
+            chosen.append((name, server_name))
+            release(deficit, resources)
+        return chosen
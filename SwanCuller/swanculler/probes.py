@@ -0,0 +1,164 @@
+"""Probes of the activity of the servers, besides the Hub last_activity
+
+The Hub last_activity counts an open browser tab as activity, and misses
+computations that run without a browser. The probes look at the server
+itself: the kernels and terminals of the single-user server, and the CPU
+usage of its container. Each probe returns a ProbeResult, whose busy is
+True when the server is doing something right now, and last_activity is
+when it last did (None when the probe doesn't know).
+"""
+import asyncio
+import json
+import time
+from collections import namedtuple
+from urllib.parse import quote
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.locks import Semaphore
+
+from .activity import parse_timestamp
+from .metrics import PROBE_REQUEST_DURATION, PROBE_RESULTS
+
+ProbeResult = namedtuple('ProbeResult', ['busy', 'last_activity'])
+
+
+class KernelsProbe(object):
+    """Execution state and last activity of the kernels and terminals
+
+    server_url is the URL where the servers are reachable (the proxy), the
+    requests are authenticated with the token of the culler, that needs
+    access to the servers. They are made with no_track_activity, otherwise
+    the server would count them as activity, and report it to the Hub.
+    A server without kernels nor terminals is idle since the last activity
+    the probe saw, or since it started.
+
+    The probe has its own HTTP client, with at most concurrency requests at
+    the same time, so that slow or paused servers don't hold the requests
+    to the Hub, nor make its concurrency limit back off.
+    """
+
+    name = 'kernels'
+
+    def __init__(self, server_url, concurrency=10, request_timeout=10):
+        self.server_url = server_url.rstrip('/')
+        self.request_timeout = request_timeout
+        self.client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+        self._semaphore = Semaphore(concurrency)
+        # last activity of the kernels and terminals, by (username, server name)
+        self._seen = {}
+
+    async def _get(self, url, headers):
+        req = HTTPRequest(url=url, headers=headers, request_timeout=self.request_timeout)
+        async with self._semaphore:
+            code = 599
+            start = time.monotonic()
+            try:
+                resp = await self.client.fetch(req)
+                code = resp.code
+            except HTTPClientError as e:
+                code = e.code
+                raise
+            finally:
+                PROBE_REQUEST_DURATION.labels(self.name, code).observe(time.monotonic() - start)
+        return json.loads(resp.body.decode('utf8', 'replace'))
+
+    async def probe(self, name, server_name, server, headers):
+        base = self.server_url + (server.get('url') or '/user/%s/' % quote(name))
+        kernels, terminals = await asyncio.gather(
+            self._get(base + 'api/kernels?no_track_activity=1', headers),
+            self._get(base + 'api/terminals?no_track_activity=1', headers),
+        )
+        busy = any(kernel.get('execution_state') == 'busy' for kernel in kernels)
+        activities = [
+            parse_timestamp(item['last_activity'])
+            for item in kernels + terminals
+            if item.get('last_activity')
+        ]
+        if self._seen.get((name, server_name)):
+            activities.append(self._seen[(name, server_name)])
+        if not activities and server.get('started'):
+            activities.append(parse_timestamp(server['started']))
+        if not activities:
+            return ProbeResult(busy, None)
+        last_activity = max(activities)
+        self._seen[(name, server_name)] = last_activity
+        return ProbeResult(busy, last_activity)
+
+    def forget(self, name, server_name):
+        self._seen.pop((name, server_name), None)
+
+
+class CgroupCpuProbe(object):
+    """CPU usage of the container, between two cycles of the culler
+
+    cgroup_template is the cgroup directory, formatted with username,
+    servername and container_id (from the spawner state). The server is busy
+    while it uses more than threshold cores. The files are read in a thread,
+    as the reads can block on a busy host.
+    """
+
+    name = 'cgroup_cpu'
+
+    def __init__(self, cgroup_template, threshold=0.05):
+        self.cgroup_template = cgroup_template
+        self.threshold = threshold
+        # (time, cpu seconds) of the previous sample, by (username, server name)
+        self._samples = {}
+
+    def _usage(self, cgroup):
+        """CPU time (in seconds) used by the cgroup, v2 or v1"""
+        try:
+            with open(cgroup + '/cpu.stat') as f:
+                for line in f:
+                    key, _, value = line.partition(' ')
+                    if key == 'usage_usec':
+                        return int(value) / 1e6
+        except FileNotFoundError:
+            pass
+        with open(cgroup + '/cpuacct.usage') as f:
+            return int(f.read()) / 1e9
+
+    async def probe(self, name, server_name, server, headers):
+        state = server.get('state') or {}
+        cgroup = self.cgroup_template.format(
+            username=name, servername=server_name, container_id=state.get('container_id') or ''
+        )
+        usage = await IOLoop.current().run_in_executor(None, self._usage, cgroup)
+        sample = (time.monotonic(), usage)
+        previous = self._samples.get((name, server_name))
+        self._samples[(name, server_name)] = sample
+        if previous is None or sample[0] <= previous[0]:
+            return ProbeResult(None, None)
+        cores = (sample[1] - previous[1]) / (sample[0] - previous[0])
+        return ProbeResult(cores > self.threshold, None)
+
+    def forget(self, name, server_name):
+        self._samples.pop((name, server_name), None)
+
+
+def load_probes(names, server_url='', cgroup_template='', cpu_threshold=0.05, concurrency=10):
+    """Create the probes from a comma-separated list of names"""
+    probes = []
+    for name in filter(None, (name.strip() for name in names.split(','))):
+        if name == 'kernels':
+            if not server_url:
+                raise ValueError("The kernels probe needs the URL of the servers")
+            probes.append(KernelsProbe(server_url, concurrency))
+        elif name == 'cgroup_cpu':
+            if not cgroup_template:
+                raise ValueError("The cgroup_cpu probe needs the cgroup template")
+            probes.append(CgroupCpuProbe(cgroup_template, cpu_threshold))
+        else:
+            raise ValueError("Unknown probe: %s" % name)
+    return probes
+
+
+def record(probe, result):
+    """Count the result of a probe in the metrics"""
+    if result.busy:
+        PROBE_RESULTS.labels(probe.name, 'busy').inc()
+    elif result.busy is None and result.last_activity is None:
+        PROBE_RESULTS.labels(probe.name, 'unknown').inc()
+    else:
+        PROBE_RESULTS.labels(probe.name, 'idle').inc()
@@ -0,0 +1,171 @@
+"""Deadline-driven scheduling of the culling checks
+
+Instead of scanning all the users every cull_every seconds, keep the
+projected cull deadline of every user with running servers in a min-heap
+and wake up exactly when the next one is due, checking only those users.
+A full scan still runs every resync_every seconds, as a safety net and to
+discover the servers started in the meantime.
+"""
+import heapq
+import random
+import time
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Lock
+from tornado.log import app_log
+
+
+class DeadlineScheduler(object):
+    """Run the culler when the users are due to be checked
+
+    cull is the culling coroutine (cull_idle with its settings),
+    called with a `schedule` callback, and with `usernames` to check
+    only some users.
+    retry_every is the delay before checking again a user whose deadline
+    already passed but could not be culled (e.g. pending or slow to stop servers).
+    The wake up is delayed by slack seconds, so that users with deadlines
+    close to each other are checked together.
+
+    With a store (StateStore), the deadlines are saved after every check and
+    restored on start, so that a restart resumes where it left instead of
+    checking all the users at once: the deadlines that passed in the
+    meantime are spread over startup_spread seconds, and the first full
+    scan only runs resync_every seconds after the previous one.
+    """
+
+    def __init__(self, cull, resync_every, retry_every, slack=1, store=None, startup_spread=60):
+        self.cull = cull
+        self.resync_every = resync_every
+        self.retry_every = retry_every
+        self.slack = slack
+        self.store = store
+        self.startup_spread = startup_spread
+        self._heap = []
+        # latest deadline of each user, older entries in the heap are ignored
+        self._deadlines = {}
+        # users whose deadline changed since the last save
+        self._changed = set()
+        self._timeout = None
+        # time of the deadline the timer is set for
+        self._armed = None
+        # a wake or resync is running, it saves and sets the timer when it finishes
+        self._busy = False
+        self._lock = Lock()
+
+    def schedule(self, name, deadline):
+        """Check the user again at deadline (a datetime, or None if unknown)"""
+        now = time.time()
+        when = deadline.timestamp() if deadline is not None else now
+        if when <= now:
+            when = now + self.retry_every
+        if self._deadlines.get(name) == when:
+            return
+        self._deadlines[name] = when
+        self._changed.add(name)
+        heapq.heappush(self._heap, (when, name))
+        if not self._busy and (self._timeout is None or when < self._armed):
+            # scheduled outside of a check, e.g. once the servers slow to stop are stopped
+            self._save()
+            self._arm()
+
+    def _save(self, replace=False):
+        if self.store is None:
+            return
+        if replace:
+            self.store.set_deadlines(self._deadlines, replace=True)
+        else:
+            self.store.set_deadlines({name: self._deadlines.get(name) for name in self._changed})
+        self._changed = set()
+
+    def _arm(self):
+        """Set the timer for the next deadline"""
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+            self._armed = None
+        while self._heap:
+            when, name = self._heap[0]
+            if self._deadlines.get(name) == when:
+                break
+            heapq.heappop(self._heap)
+        else:
+            return
+        delay = max(0, when + self.slack - time.time())
+        app_log.debug("Next user due to be checked in %i seconds", delay)
+        self._armed = when
+        self._timeout = IOLoop.current().call_later(delay, self.wake)
+
+    def _pop_due(self):
+        """Remove and return the users whose deadline is due"""
+        due = []
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            when, name = heapq.heappop(self._heap)
+            if self._deadlines.get(name) == when:
+                del self._deadlines[name]
+                self._changed.add(name)
+                due.append(name)
+        return due
+
+    async def wake(self):
+        """Check the users whose deadline is due"""
+        self._timeout = None
+        self._armed = None
+        async with self._lock:
+            self._busy = True
+            due = self._pop_due()
+            try:
+                if due:
+                    app_log.debug("Checking %i users due to be culled", len(due))
+                    await self.cull(usernames=due, schedule=self.schedule)
+            except Exception:
+                app_log.exception("Error checking users %s", due)
+                for name in due:
+                    self.schedule(name, None)
+            finally:
+                self._busy = False
+                self._save()
+                self._arm()
+
+    async def resync(self):
+        """Check all the users and rebuild their deadlines"""
+        async with self._lock:
+            self._busy = True
+            self._heap = []
+            self._deadlines = {}
+            try:
+                await self.cull(schedule=self.schedule)
+            except Exception:
+                app_log.exception("Error resyncing the users")
+            finally:
+                self._busy = False
+                if self.store is not None:
+                    self.store.set_meta('last_resync', time.time())
+                self._save(replace=True)
+                self._arm()
+
+    def _restore(self):
+        """Load the saved deadlines, returns the delay before the first full scan"""
+        deadlines = self.store.get_deadlines()
+        last_resync = self.store.get_meta('last_resync')
+        if not deadlines or last_resync is None:
+            return 0
+        now = time.time()
+        for name, when in deadlines.items():
+            if when <= now:
+                when = now + random.uniform(0, self.startup_spread)
+            self._deadlines[name] = when
+            self._heap.append((when, name))
+        heapq.heapify(self._heap)
+        app_log.info("Restored the deadlines of %i users", len(deadlines))
+        self._arm()
+        return max(last_resync + self.resync_every - now, random.uniform(0, self.startup_spread))
+
+    def start(self):
+        delay = self._restore() if self.store is not None else 0
+        IOLoop.current().call_later(delay, self._start_resync)
+
+    def _start_resync(self):
+        IOLoop.current().add_callback(self.resync)
+        self._resync_callback = PeriodicCallback(self.resync, 1e3 * self.resync_every)
+        self._resync_callback.start()
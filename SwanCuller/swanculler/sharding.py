@@ -0,0 +1,106 @@
+"""Split the users among several culler replicas
+
+Every replica owns the usernames that a consistent hash ring of the live
+replicas assigns to it, and only culls those. The live replicas are found
+through lease files in a directory shared by all of them (e.g. a shared
+volume): when a replica joins, or its lease expires, the ring is rebuilt
+and only the usernames of the affected ring segments move to another replica.
+"""
+import bisect
+import hashlib
+import os
+import time
+
+from tornado.ioloop import PeriodicCallback
+from tornado.log import app_log
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """Consistent hash ring, with vnodes points per member"""
+
+    def __init__(self, members, vnodes=64):
+        self.members = frozenset(members)
+        points = sorted(
+            (_hash('%s#%i' % (member, i)), member) for member in self.members for i in range(vnodes)
+        )
+        self._hashes = [point for point, member in points]
+        self._members = [member for point, member in points]
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._members[i]
+
+
+class FileLeaseCoordinator(object):
+    """Find the live replicas through lease files in a shared directory
+
+    Every replica keeps the file <lease_dir>/<replica_id>.lease, with the
+    time its lease expires, renewed every ttl/3 seconds. Replicas whose
+    lease has expired are considered gone.
+    """
+
+    def __init__(self, lease_dir, replica_id, ttl=60):
+        self.lease_dir = lease_dir
+        self.replica_id = replica_id
+        self.ttl = ttl
+        self.ring = HashRing([replica_id])
+        self._renew_callback = None
+
+    @property
+    def _lease_file(self):
+        return os.path.join(self.lease_dir, '%s.lease' % self.replica_id)
+
+    def _live_replicas(self):
+        now = time.time()
+        replicas = {self.replica_id}
+        for filename in os.listdir(self.lease_dir):
+            if not filename.endswith('.lease'):
+                continue
+            try:
+                with open(os.path.join(self.lease_dir, filename)) as f:
+                    expires = float(f.read())
+            except (OSError, ValueError):
+                # being written, or removed in the meantime
+                continue
+            if expires > now:
+                replicas.add(filename[: -len('.lease')])
+        return replicas
+
+    def renew(self):
+        """Renew our lease and rebalance if replicas joined or left"""
+        try:
+            tmp_file = self._lease_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                f.write(str(time.time() + self.ttl))
+            os.replace(tmp_file, self._lease_file)
+            replicas = self._live_replicas()
+        except OSError:
+            app_log.exception("Error renewing the lease of %s", self.replica_id)
+            return
+        if replicas != self.ring.members:
+            app_log.info("Culler replicas changed, now: %s", ', '.join(sorted(replicas)))
+            self.ring = HashRing(replicas)
+
+    def owns(self, username):
+        return self.ring.owner(username) == self.replica_id
+
+    def start(self):
+        os.makedirs(self.lease_dir, exist_ok=True)
+        self.renew()
+        self._renew_callback = PeriodicCallback(self.renew, 1e3 * self.ttl / 3)
+        self._renew_callback.start()
+
+    def stop(self):
+        """Give up our lease, so the other replicas take over our users"""
+        if self._renew_callback is not None:
+            self._renew_callback.stop()
+        try:
+            os.remove(self._lease_file)
+        except OSError:
+            pass
@@ -0,0 +1,286 @@
+"""Replay user activity through the culler to compare culling policies
+
+The activity comes from recorded snapshots of the Hub /users API, or from
+a synthetic trace. For every policy, the culler runs with its usual logic
+against a local stand-in Hub that shows the sessions running at the
+simulated time, and the simulation reports:
+
+- the number of servers culled;
+- how many of those were interrupted, i.e. their user was active again
+  afterwards (the session is then considered respawned at that moment);
+- the resource-hours (cores x hours) reclaimed by the culling;
+- the number of requests made to the Hub.
+
+Usage:
+
+    swanculler simulate --snapshots users.jsonl --policy timeout=3600 --policy timeout=1800,cull_every=300
+    swanculler simulate --synthetic 1000 --duration 86400 --policy timeout=7200,max_age=43200
+
+Snapshots are given as a JSON list, or JSON lines, of objects with the
+time of the snapshot and the users returned by the Hub at that time, e.g.
+{"time": "2021-01-01T10:00:00Z", "users": [...]}. Sessions are assumed to
+stop after the last snapshot where they appear, so snapshots taken with a
+culler running only allow to compare more aggressive policies.
+"""
+import argparse
+import bisect
+import json
+import logging
+import random
+from datetime import datetime, timezone
+
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
+
+from .app import cull_idle, parse_date
+from .fakehub import FakeHub
+
+
+class Session(object):
+    """A server of a user, from start to stop, with the times it was active"""
+
+    def __init__(self, user, server, started, stopped, activity, cores=1):
+        self.user = user
+        self.server = server
+        self.started = started
+        self.stopped = stopped
+        self.activity = sorted(activity)
+        self.cores = cores
+        self.reset()
+
+    def reset(self):
+        # the session is not running until this time, after being culled
+        self.down_until = self.started
+        self.culls = []
+
+    def running_at(self, t):
+        return self.started <= t < self.stopped and t >= self.down_until
+
+    def last_activity(self, t):
+        i = bisect.bisect_right(self.activity, t)
+        return self.activity[i - 1] if i else None
+
+    def cull(self, t):
+        """Record a cull at t, the session respawns on the next activity"""
+        i = bisect.bisect_right(self.activity, t)
+        respawn = self.activity[i] if i < len(self.activity) else None
+        if respawn is not None and respawn >= self.stopped:
+            respawn = None
+        self.culls.append((t, respawn))
+        self.down_until = respawn if respawn is not None else self.stopped
+
+
+def _isoformat(t):
+    return datetime.fromtimestamp(t, timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def _cores(server):
+    """Number of cores of a server, from the spawner state or the user options"""
+    for key in ('state', 'user_options'):
+        value = (server.get(key) or {}).get('ncores')
+        if value:
+            return float(value)
+    return 1
+
+
+def load_snapshots(path):
+    """Create the sessions from a file with snapshots of the /users API"""
+    with open(path) as f:
+        content = f.read()
+    if content.lstrip().startswith('['):
+        snapshots = json.loads(content)
+    else:
+        snapshots = [json.loads(line) for line in content.splitlines() if line.strip()]
+    snapshots.sort(key=lambda snapshot: parse_date(snapshot['time']))
+
+    sessions = {}
+    for snapshot in snapshots:
+        t = parse_date(snapshot['time']).timestamp()
+        for user in snapshot['users']:
+            for server_name, server in (user.get('servers') or {}).items():
+                started = parse_date(server['started']).timestamp() if server.get('started') else t
+                key = (user['name'], server_name, started)
+                session = sessions.get(key)
+                if session is None:
+                    session = sessions[key] = Session(
+                        user['name'], server_name, started, t, [], _cores(server)
+                    )
+                session.stopped = t
+                if server.get('last_activity'):
+                    session.activity.append(parse_date(server['last_activity']).timestamp())
+    for session in sessions.values():
+        session.activity = sorted(set(session.activity))
+    return list(sessions.values())
+
+
+def synthetic_sessions(n_users, duration, seed=None):
+    """Create one session per user, with bursts of work separated by breaks
+
+    Each session has 1 to 3 bursts of work (1h on average, with activity
+    every 2 minutes), separated by breaks of 45 minutes on average, and is
+    left idle for 6h on average after the last burst.
+    """
+    rng = random.Random(seed)
+    start = 1600000000.0
+    sessions = []
+    for i in range(n_users):
+        t = start + rng.uniform(0, duration * 0.8)
+        activity = []
+        for burst in range(rng.randint(1, 3)):
+            end = t + rng.expovariate(1 / 3600)
+            while t < end:
+                activity.append(t)
+                t += rng.expovariate(1 / 120)
+            t = end + rng.expovariate(1 / 2700)
+        stopped = min(activity[-1] + rng.expovariate(1 / 21600), start + duration)
+        cores = rng.choice([1, 2, 4, 8])
+        sessions.append(Session('user%i' % i, '', activity[0], stopped, activity, cores))
+    return sessions
+
+
+class TraceHub(FakeHub):
+    """Fake Hub with the sessions running at the simulated time"""
+
+    def __init__(self, sessions):
+        super().__init__()
+        self.sessions = sessions
+        self.time = None
+        self._running = {}
+
+    def set_time(self, t):
+        self.time = t
+        self.users = {}
+        self._running = {}
+        for session in self.sessions:
+            if not session.running_at(t):
+                continue
+            last_activity = session.last_activity(t)
+            started = max(session.started, session.down_until)
+            user = self.users.setdefault(
+                session.user,
+                {
+                    'name': session.user,
+                    'admin': False,
+                    'created': _isoformat(session.started),
+                    'last_activity': None,
+                    'servers': {},
+                },
+            )
+            user['servers'][session.server] = {
+                'name': session.server,
+                'ready': True,
+                'pending': None,
+                'url': '/user/%s/%s' % (session.user, session.server),
+                'started': _isoformat(started),
+                'last_activity': _isoformat(last_activity)
+                if last_activity and last_activity >= started
+                else None,
+                'state': {'ncores': session.cores},
+            }
+            self._running[(session.user, session.server)] = session
+
+    def stop_server(self, name, server_name):
+        self._running[(name, server_name)].cull(self.time)
+        return super().stop_server(name, server_name)
+
+
+async def simulate(sessions, timeout, max_age=0, cull_every=0, concurrency=10):
+    """Run the culler over the sessions, returns the results of the policy"""
+    cull_every = cull_every or timeout // 2
+    for session in sessions:
+        session.reset()
+    hub = TraceHub(sessions)
+    url = hub.listen()
+    try:
+        t = min(session.started for session in sessions)
+        end = max(session.stopped for session in sessions)
+        while t <= end:
+            hub.set_time(t)
+            await cull_idle(
+                url,
+                'simulation',
+                inactive_limit=timeout,
+                max_age=max_age,
+                concurrency=concurrency,
+                now=datetime.fromtimestamp(t, timezone.utc),
+            )
+            t += cull_every
+    finally:
+        hub.stop()
+
+    culls = [(session, cull) for session in sessions for cull in session.culls]
+    reclaimed = 0
+    for session, (culled, respawn) in culls:
+        back = respawn if respawn is not None else session.stopped
+        reclaimed += (back - culled) * session.cores / 3600
+    return {
+        'culls': len(culls),
+        'interrupted': sum(1 for session, (culled, respawn) in culls if respawn is not None),
+        'reclaimed': reclaimed,
+        'requests': sum(hub.requests.values()),
+    }
+
+
+def parse_policy(value):
+    """Parse a policy like timeout=3600,max_age=0,cull_every=600"""
+    policy = {}
+    for item in value.split(','):
+        key, _, number = item.partition('=')
+        key = key.strip().replace('-', '_')
+        if key not in ('timeout', 'max_age', 'cull_every'):
+            raise argparse.ArgumentTypeError("Unknown policy setting: %s" % key)
+        policy[key] = int(number)
+    if 'timeout' not in policy:
+        raise argparse.ArgumentTypeError("The policy needs a timeout")
+    return policy
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='swanculler simulate', description="Compare culling policies on recorded or synthetic activity"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--snapshots', help="File with snapshots of the Hub /users API")
+    source.add_argument('--synthetic', type=int, help="Number of users of a synthetic trace")
+    parser.add_argument('--duration', type=int, default=86400, help="Duration (in seconds) of the synthetic trace")
+    parser.add_argument('--seed', type=int, default=None, help="Random seed of the synthetic trace")
+    parser.add_argument(
+        '--policy',
+        type=parse_policy,
+        action='append',
+        required=True,
+        help="Culling policy to simulate, e.g. timeout=3600,max_age=0,cull_every=600 (can be repeated)",
+    )
+    parser.add_argument('--concurrency', type=int, default=10, help="Concurrent requests to the fake Hub")
+    args = parser.parse_args(argv)
+
+    # the culler logs every server culled
+    app_log.setLevel(logging.WARNING)
+
+    if args.snapshots:
+        sessions = load_snapshots(args.snapshots)
+    else:
+        sessions = synthetic_sessions(args.synthetic, args.duration, args.seed)
+    if not sessions:
+        parser.error("No sessions to simulate")
+    total = sum((session.stopped - session.started) * session.cores for session in sessions) / 3600
+    print("%i sessions, %.1f resource-hours without culling" % (len(sessions), total))
+
+    header = "%-40s %8s %12s %20s %10s"
+    print(header % ('policy', 'culls', 'interrupted', 'resource-hours', 'requests'))
+    for policy in args.policy:
+        results = IOLoop.current().run_sync(
+            lambda: simulate(sessions, concurrency=args.concurrency, **policy)
+        )
+        name = ','.join('%s=%s' % item for item in policy.items())
+        print(
+            "%-40s %8i %12i %11.1f (%4.1f%%) %10i"
+            % (
+                name,
+                results['culls'],
+                results['interrupted'],
+                results['reclaimed'],
+                100 * results['reclaimed'] / total if total else 0,
+                results['requests'],
+            )
+        )
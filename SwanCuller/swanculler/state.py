@@ -0,0 +1,171 @@
+"""State of the culler that is kept across restarts, in a SQLite database"""
+import json
+import sqlite3
+
+
+class StateStore(object):
+    """Small persistent store for the culler
+
+    Keeps, for every user, the time of the last successful ticket check and
+    the known expiry time of the ticket (both as unix timestamps), and the
+    state the culler needs to resume after a restart: the users seen with
+    active servers, the servers slow to stop, the paused servers, the next
+    deadline of every user and the time of the last full cycle.
+    Use ':memory:' as path to keep the state only while the culler runs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS tickets ('
+                'username TEXT PRIMARY KEY, checked REAL NOT NULL, expires REAL NOT NULL)'
+            )
+            for table in ('active_users', 'slow_stops'):
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS %s (username TEXT PRIMARY KEY)' % table
+                )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS paused ('
+                'username TEXT NOT NULL, server_name TEXT NOT NULL, target TEXT NOT NULL, '
+                'PRIMARY KEY (username, server_name))'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS deadlines (username TEXT PRIMARY KEY, deadline REAL NOT NULL)'
+            )
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)')
+
+    def get_ticket(self, username):
+        """Returns (checked, expires) for the user, None if unknown"""
+        return self._db.execute(
+            'SELECT checked, expires FROM tickets WHERE username = ?', (username,)
+        ).fetchone()
+
+    def set_tickets(self, tickets, checked):
+        """Store the tickets checked at the same time, given as {username: expires}"""
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO tickets (username, checked, expires) VALUES (?, ?, ?)',
+                [(username, checked, expires) for username, expires in tickets.items()],
+            )
+
+    def delete_tickets(self, usernames):
+        with self._db:
+            self._db.executemany(
+                'DELETE FROM tickets WHERE username = ?', [(username,) for username in usernames]
+            )
+
+    def user_set(self, table):
+        """Set of usernames (active_users or slow_stops) saved on every change"""
+        names = [row[0] for row in self._db.execute('SELECT username FROM %s' % table)]
+        return PersistentUserSet(self, table, names)
+
+    def _add_users(self, table, usernames):
+        with self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO %s (username) VALUES (?)' % table,
+                [(username,) for username in usernames],
+            )
+
+    def _remove_users(self, table, usernames):
+        with self._db:
+            self._db.executemany(
+                'DELETE FROM %s WHERE username = ?' % table, [(username,) for username in usernames]
+            )
+
+    def _clear_users(self, table):
+        with self._db:
+            self._db.execute('DELETE FROM %s' % table)
+
+    def get_paused(self):
+        """Returns the backend target of the paused servers, by (username, server name)"""
+        return {
+            (username, server_name): json.loads(target)
+            for username, server_name, target in self._db.execute(
+                'SELECT username, server_name, target FROM paused'
+            )
+        }
+
+    def set_paused(self, username, server_name, target):
+        """Store the target of a paused server, None once it's resumed"""
+        with self._db:
+            if target is None:
+                self._db.execute(
+                    'DELETE FROM paused WHERE username = ? AND server_name = ?',
+                    (username, server_name),
+                )
+            else:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO paused (username, server_name, target) VALUES (?, ?, ?)',
+                    (username, server_name, json.dumps(target)),
+                )
+
+    def get_deadlines(self):
+        """Returns the next deadline of the users, as {username: unix timestamp}"""
+        return dict(self._db.execute('SELECT username, deadline FROM deadlines'))
+
+    def set_deadlines(self, deadlines, replace=False):
+        """Store the deadlines given as {username: timestamp or None to remove it}
+
+        With replace, the deadlines of all the other users are removed.
+        """
+        with self._db:
+            if replace:
+                self._db.execute('DELETE FROM deadlines')
+            self._db.executemany(
+                'DELETE FROM deadlines WHERE username = ?',
+                [(username,) for username, when in deadlines.items() if when is None],
+            )
+            self._db.executemany(
+                'INSERT OR REPLACE INTO deadlines (username, deadline) VALUES (?, ?)',
+                [(username, when) for username, when in deadlines.items() if when is not None],
+            )
+
+    def get_meta(self, key):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def close(self):
+        self._db.close()
+
+
+class PersistentUserSet(set):
+    """Set of usernames that writes its changes to the store
+
+    Only the methods used by the culler (add, discard, update,
+    difference_update, clear) are persisted.
+    """
+
+    def __init__(self, store, table, names=()):
+        super().__init__(names)
+        self._store = store
+        self._table = table
+
+    def add(self, name):
+        if name not in self:
+            super().add(name)
+            self._store._add_users(self._table, [name])
+
+    def discard(self, name):
+        if name in self:
+            super().discard(name)
+            self._store._remove_users(self._table, [name])
+
+    def update(self, names):
+        new = set(names) - self
+        super().update(new)
+        self._store._add_users(self._table, new)
+
+    def difference_update(self, names):
+        gone = self & set(names)
+        super().difference_update(gone)
+        self._store._remove_users(self._table, gone)
+
+    def clear(self):
+        super().clear()
+        self._store._clear_users(self._table)
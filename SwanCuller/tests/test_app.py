@@ -0,0 +1,66 @@
+"""Culling cycles against the local stand-in Hub"""
+from datetime import datetime, timedelta, timezone
+
+from tornado.ioloop import IOLoop
+
+from swanculler.app import cull_idle
+from swanculler.fakehub import FakeHub
+
+
+def _user(name, inactive):
+    now = datetime.now(timezone.utc)
+    last_activity = (now - timedelta(seconds=inactive)).isoformat()
+    return {
+        'name': name,
+        'created': (now - timedelta(days=1)).isoformat(),
+        'last_activity': last_activity,
+        'servers': {
+            '': {
+                'name': '',
+                'url': '/user/%s/' % name,
+                'ready': True,
+                'pending': None,
+                'started': (now - timedelta(hours=1)).isoformat(),
+                'last_activity': last_activity,
+            }
+        },
+    }
+
+
+class FailingHooks(object):
+    """Ticket hooks whose every call fails, like a broken state store"""
+
+    def __init__(self):
+        self.calls = []
+
+    def check(self, username):
+        self.calls.append(('check', username))
+        raise OSError("database is locked")
+
+    def delete(self, username):
+        self.calls.append(('delete', username))
+        raise OSError("database is locked")
+
+    async def flush(self):
+        pass
+
+
+def test_cycle_completes_when_the_hooks_fail():
+    # more users than workers and than the queue can hold
+    users = {'idle%i' % i: _user('idle%i' % i, 3600) for i in range(5)}
+    users.update({'active%i' % i: _user('active%i' % i, 10) for i in range(5)})
+    hub = FakeHub(users)
+    hooks = FailingHooks()
+
+    async def cycle():
+        url = hub.listen()
+        try:
+            await cull_idle(url, 'token', 600, hooks=hooks, workers=1, concurrency=1)
+        finally:
+            hub.stop()
+
+    IOLoop.current().run_sync(cycle, timeout=30)
+    assert sorted(name for name, user in hub.users.items() if user['servers']) == [
+        'active%i' % i for i in range(5)
+    ]
+    assert len(hooks.calls) == 10
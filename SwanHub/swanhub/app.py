@@ -6,11 +6,12 @@ import jupyterhub.handlers.base as base
 import jupyterhub.apihandlers.users as users
 from jupyterhub.utils import url_path_join
 from jupyterhub import app
+from jupyterhub.proxy import ConfigurableHTTPProxy
 from .spawn_handler import SpawnHandler
 from .error_handler import ProxyErrorHandler
 from .userapi_handler import SelfAPIHandler
 from . import get_templates
-from traitlets import default
+from traitlets import Integer, Unicode, default
 import sys
 import os
 
@@ -24,6 +25,22 @@ handlers_map = {
 class SWAN(app.JupyterHub):
     name = 'swan'
 
+    culler_url = Unicode(
+        '',
+        config=True,
+        help="""URL of SwanCuller (e.g. http://localhost:9090), to resume the servers it paused
+        when the proxy can't reach them. Authenticated with $SWANCULLER_ACTIVITY_TOKEN."""
+    )
+
+    proxy_timeout = Integer(
+        30,
+        config=True,
+        help="""Time (in seconds) the proxy waits for a server to answer, passed to configurable-http-proxy
+        as --proxy-timeout when culler_url is set (0 to keep the command of the proxy as it is).
+        A paused server doesn't refuse the connections, and the proxy has no timeout by default,
+        so without it the requests hang instead of failing, and the server is never resumed."""
+    )
+
     @default('template_paths')
     def _template_paths_default(self):
         return [get_templates(), os.path.join(self.data_files_path, 'templates')]
@@ -40,8 +57,21 @@ class SWAN(app.JupyterHub):
         for template_path in self._template_paths_default():
             if template_path not in self.template_paths:
                 self.template_paths.append(template_path)
+        self.tornado_settings.setdefault('swan_culler_url', self.culler_url)
         super().init_tornado_settings()
 
+    def init_proxy(self):
+        super().init_proxy()
+        if not self.culler_url:
+            return
+        if not isinstance(self.proxy, ConfigurableHTTPProxy) or not self.proxy.should_start:
+            self.log.warning(
+                "The paused servers are only resumed if the proxy times out their requests: "
+                "start configurable-http-proxy with --proxy-timeout"
+            )
+        elif self.proxy_timeout and not any(arg.startswith('--proxy-timeout') for arg in self.proxy.command):
+            self.proxy.command = self.proxy.command + ['--proxy-timeout', str(1000 * self.proxy_timeout)]
+
     def init_handlers(self):
         super().init_handlers()
         for i, cur_handler in enumerate(self.handlers):
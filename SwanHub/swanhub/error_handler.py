@@ -1,5 +1,8 @@
-
 import jupyterhub.handlers.pages as pages
+from jupyterhub.utils import url_path_join
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+import json
+import os
 
 
 class ProxyErrorHandler(pages.ProxyErrorHandler):
@@ -13,6 +16,14 @@ class ProxyErrorHandler(pages.ProxyErrorHandler):
     async def get(self, status_code_s):
         status_code = int(status_code_s)
 
+        # The container might be paused by the culler, in which case we resume it
+        # and send the user back to where they were going
+        if status_code in (503, 504):
+            next_url = await self._resume_paused_server()
+            if next_url:
+                self.redirect(next_url)
+                return
+
         # If the error is container not reachable, redirect to home#changeconfig
         # where the cleanup will take place (including removing the stored configuration 
         # which might be causing the problem)
@@ -24,3 +35,31 @@ class ProxyErrorHandler(pages.ProxyErrorHandler):
 
         else:
             super().get(status_code_s)
+
+    async def _resume_paused_server(self):
+        """ Ask the culler to resume the servers of the user, returns the url to retry if any was paused """
+        culler_url = self.settings.get('swan_culler_url')
+        token = os.environ.get('SWANCULLER_ACTIVITY_TOKEN')
+        user = self.current_user
+        url = self.get_argument('url', '')
+        if not (culler_url and token and user and url.startswith(user.url)):
+            return None
+
+        req = HTTPRequest(
+            url_path_join(culler_url, 'users', user.name, 'resume'),
+            method='POST',
+            body='',
+            headers={'Authorization': 'token %s' % token},
+            request_timeout=10,
+        )
+        try:
+            resp = await AsyncHTTPClient().fetch(req)
+            resumed = json.loads(resp.body.decode('utf8', 'replace'))['resumed']
+        except (HTTPClientError, OSError, ValueError, KeyError) as e:
+            self.log.warning("Failed to resume the servers of %s: %s", user.name, e)
+            return None
+
+        if not resumed:
+            return None
+        self.log.info("Resumed paused servers of %s", user.name)
+        return url
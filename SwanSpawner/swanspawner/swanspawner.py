@@ -218,6 +218,15 @@ def define_SwanSpawner_from(base_class):
 
             return startup
 
+        def get_state(self):
+            """ Add the resources of the session to the state, used by the culler to reclaim the biggest idle sessions first """
+            state = super().get_state()
+            if self.user_n_cores in self.user_options:
+                state[self.user_n_cores] = self.user_options[self.user_n_cores]
+                state[self.user_memory] = self.user_options.get(self.user_memory)
+                state['gpu'] = "cu" in self.user_options.get(self.lcg_rel_field, '')
+            return state
+
         def log_metric(self, user, host, metric, value):
             """ Function allowing for logging formatted metrics """
             self.log.info("user: %s, host: %s, metric: %s, value: %s" % (user, host, metric, value))